@@ -8,16 +8,34 @@ Main application module for Code Repository Q&A System.
 Provides FastAPI endpoints for semantic code search using RAG architecture.
 """
 import os
+import json
+import hashlib
 import zipfile
 import tempfile
-import shutil
-from typing import List, Dict, Tuple
+import threading
+import time
+import itertools
+import multiprocessing
+from array import array
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import List, Dict, Tuple, Iterable, Iterator, Optional, Union, BinaryIO
 from pathlib import Path
 import re
 
+try:
+    from tree_sitter import Parser
+    from tree_sitter_languages import get_language
+except ImportError:  # tree-sitter is optional; regex chunkers are used instead
+    Parser = get_language = None
+
 
 class CodeChunk:
     """Represents a chunk of code with metadata"""
+    # No per-instance __dict__: large repos produce hundreds of thousands of chunks
+    __slots__ = ('content', 'file_path', 'start_line', 'end_line', 'language', 'chunk_type')
+    
     def __init__(self, content: str, file_path: str, start_line: int, 
                  end_line: int, language: str, chunk_type: str = "block"):
         self.content = content
@@ -36,6 +54,70 @@ class CodeChunk:
             "language": self.language,
             "chunk_type": self.chunk_type
         }
+    
+    @classmethod
+    def from_row(cls, table: 'ChunkTable', i: int) -> 'CodeChunk':
+        """Materialize row i of a ChunkTable as a CodeChunk"""
+        return cls(
+            content=table.content[i],
+            file_path=table.file_paths[table.file_path_codes[i]],
+            start_line=table.start_lines[i],
+            end_line=table.end_lines[i],
+            language=table.languages[table.language_codes[i]],
+            chunk_type=table.chunk_types[table.chunk_type_codes[i]]
+        )
+
+
+class ChunkTable:
+    """Column-oriented store of chunks.
+    
+    Each field is a parallel column; line numbers are packed int32 arrays and
+    file_path/language/chunk_type are dictionary-encoded (a list of distinct
+    values plus a uint32 code per row), so a file's path is stored once no
+    matter how many chunks it produced.
+    """
+    
+    def __init__(self):
+        self.content: List[str] = []
+        self.start_lines = array('i')
+        self.end_lines = array('i')
+        self.file_paths: List[str] = []
+        self.file_path_codes = array('I')
+        self.languages: List[str] = []
+        self.language_codes = array('I')
+        self.chunk_types: List[str] = []
+        self.chunk_type_codes = array('I')
+        self._codes = ({}, {}, {})
+    
+    def __len__(self) -> int:
+        return len(self.content)
+    
+    def append(self, chunk: CodeChunk):
+        """Add one chunk as a new row"""
+        self.content.append(chunk.content)
+        self.start_lines.append(chunk.start_line)
+        self.end_lines.append(chunk.end_line)
+        self.file_path_codes.append(self._encode(0, self.file_paths, chunk.file_path))
+        self.language_codes.append(self._encode(1, self.languages, chunk.language))
+        self.chunk_type_codes.append(self._encode(2, self.chunk_types, chunk.chunk_type))
+    
+    def _encode(self, column: int, values: List[str], value: str) -> int:
+        """Dictionary code for value, adding it to the column's dictionary if new"""
+        codes = self._codes[column]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(values)
+            values.append(value)
+        return code
+    
+    def column(self, name: str) -> list:
+        """Decoded values of one column, e.g. table.column('file_path')"""
+        if name == 'content':
+            return self.content
+        if name in ('start_line', 'end_line'):
+            return getattr(self, name + 's').tolist()
+        values = getattr(self, name + 's')
+        return [values[code] for code in getattr(self, name + '_codes')]
 
 
 class CodeParser:
@@ -73,38 +155,176 @@ class CodeParser:
     }
     
     # Files/directories to ignore
-    IGNORE_PATTERNS = {
+    IGNORE_PATTERNS = frozenset({
         '__pycache__', 'node_modules', '.git', '.venv', 'venv',
         'dist', 'build', '.next', '.cache', 'target', 'bin', 'obj',
         '.pytest_cache', 'coverage', '.idea', '.vscode'
+    })
+
+    # Languages chunked from a tree-sitter AST when the grammars are installed
+    AST_LANGUAGES = ('python', 'javascript', 'typescript')
+
+    # AST node types emitted as function/class chunks
+    AST_FUNCTION_TYPES = {
+        'function_definition', 'function_declaration', 'method_definition',
+        'arrow_function', 'generator_function_declaration'
+    }
+    AST_CLASS_TYPES = {'class_definition', 'class_declaration'}
+
+    # Oversized nodes of these types are split by lines, not into their
+    # token-sized children (quotes, fragments, substitutions)
+    AST_OPAQUE_TYPES = {'string', 'concatenated_string', 'template_string', 'comment'}
+
+    # Spans with less non-whitespace than this (a lone decorator, a class
+    # header, a closing brace) are folded into a neighbour, even past the budget
+    AST_MIN_CHUNK = 100
+
+    # Wrapper nodes whose chunk type comes from the definition they hold
+    AST_WRAPPER_TYPES = {
+        'decorated_definition', 'export_statement', 'lexical_declaration',
+        'variable_declarator'
     }
     
     # Binary and non-text extensions to skip
-    SKIP_EXTENSIONS = {
+    SKIP_EXTENSIONS = frozenset({
         '.pyc', '.pyo', '.so', '.dylib', '.dll', '.exe', '.bin',
         '.jpg', '.jpeg', '.png', '.gif', '.pdf', '.zip', '.tar',
         '.gz', '.mp4', '.mp3', '.lock', '.min.js', '.map'
-    }
+    })
+    
+    # Definition patterns for the regex chunkers, compiled once at import and
+    # run over the whole file in one pass ([^\S\n] keeps matches on one line)
+    _PY_DEF_SCAN = re.compile(rb'^[^\S\n]*(?:def|class)[^\S\n]+\w', re.MULTILINE)
+    _JS_DEF_SCAN = re.compile(
+        rb'^[^\S\n]*(?:export[^\S\n]+)?'
+        rb'(?:(?:default[^\S\n]+)?class|(?:async[^\S\n]+)?(?:function|const|let|var))'
+        rb'[^\S\n]+\w',
+        re.MULTILINE
+    )
+    _LEADING_BLANK_LINES = re.compile(rb'(?:[^\S\n]*\n)*')
+    
+    # A NUL byte near the start marks a file as binary
+    BINARY_SNIFF = b'\x00'
+    BINARY_SNIFF_BYTES = 8192
+    
+    # Part of every parse cache key; bump whenever chunk output changes, so
+    # caches written by older chunking logic are never served
+    CHUNKER_VERSION = 3
+    
+    # Below this many files the process pool costs more than it saves
+    PARALLEL_MIN_FILES = 64
+    # Files per worker task; amortizes pickling/IPC over many small files
+    PARALLEL_BATCH_SIZE = 32
     
-    def __init__(self, max_chunk_size: int = 1000, overlap: int = 100):
+    def __init__(self, max_chunk_size: int = 1000, overlap: int = 100,
+                 max_workers: int = None, cache_dir: str = None,
+                 max_file_bytes: int = 2 * 1024 * 1024):
         self.max_chunk_size = max_chunk_size
         self.overlap = overlap
+        # Larger files (bundles, dumps, generated code) are never read
+        self.max_file_bytes = max_file_bytes
+        self.max_workers = max_workers or os.cpu_count() or 1
+        # Parsed chunks keyed by file content hash; None disables the cache
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self._languages = {}
+        if get_language is not None:
+            self._languages = {lang: get_language(lang) for lang in self.AST_LANGUAGES}
+        # One tree-sitter parser per language per thread, reused across files
+        self._local = threading.local()
+        # Long-lived worker processes shared by every parse; see start_pool()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # Language -> chunker; anything missing falls back to chunk_by_lines
+        self._chunkers = {
+            'python': self.chunk_python,
+            'javascript': self.chunk_javascript,
+            'typescript': self.chunk_javascript,
+        }
+        # Semantic chunking takes over wherever a grammar is available
+        self._chunkers.update((lang, self._chunk_ast) for lang in self._languages)
     
-    def extract_zip(self, zip_path: str) -> str:
-        """Extract zip file to temporary directory"""
-        temp_dir = tempfile.mkdtemp()
+    def parse_zip(self, zip_file: Union[str, BinaryIO]) -> Iterator[CodeChunk]:
+        """Yield chunks straight from a zip archive's members, without extracting to disk.
+        
+        Accepts a path or an open, seekable binary file.
+        """
         try:
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                zip_ref.extractall(temp_dir)
-            return temp_dir
+            zip_ref = zipfile.ZipFile(zip_file, 'r')
         except Exception as e:
-            shutil.rmtree(temp_dir, ignore_errors=True)
-            raise Exception(f"Failed to extract zip: {str(e)}")
+            raise Exception(f"Failed to read zip: {str(e)}")
+        
+        with zip_ref:
+            members = []
+            for info in zip_ref.infolist():
+                if info.is_dir():
+                    continue
+                language = self._classify_member(info.filename)
+                if language is not None:
+                    members.append((info, language))
+            
+            if len(members) < self.PARALLEL_MIN_FILES or self.max_workers == 1:
+                for info, language in members:
+                    yield from self._parse_zip_member(zip_ref, info, language)
+                return
+            
+            # Chunking is CPU-bound, so batches of members are read here and
+            # chunked in worker processes, with a bounded number in flight
+            settings = self._settings()
+            batches = _batched(members, self.PARALLEL_BATCH_SIZE)
+            for batch_chunks in _ordered_results(
+                    self.start_pool(), _chunk_members_worker,
+                    ((self._read_members(zip_ref, batch), settings) for batch in batches),
+                    window=self.max_workers * 2):
+                yield from batch_chunks
     
-    def should_ignore(self, path: Path) -> bool:
-        """Check if path should be ignored"""
-        parts = path.parts
-        return any(pattern in parts for pattern in self.IGNORE_PATTERNS)
+    def _parse_zip_member(self, zip_ref: zipfile.ZipFile, info: zipfile.ZipInfo,
+                          language: str) -> List[CodeChunk]:
+        """Read and chunk one archive member"""
+        if info.file_size > self.max_file_bytes:
+            return [self._skipped_large(info.filename, language, info.file_size)]
+        try:
+            with zip_ref.open(info) as f:
+                data = f.read()
+        except Exception as e:
+            print(f"Error reading {info.filename}: {e}")
+            return []
+        return self._chunk_bytes(data, info.filename, language)
+    
+    def _read_members(self, zip_ref: zipfile.ZipFile,
+                      batch: List[Tuple[zipfile.ZipInfo, str]]) -> List[tuple]:
+        """(name, language, data, size) per member; data is None if oversized or unreadable"""
+        items = []
+        for info, language in batch:
+            data = None
+            if info.file_size <= self.max_file_bytes:
+                try:
+                    with zip_ref.open(info) as f:
+                        data = f.read()
+                except Exception as e:
+                    print(f"Error reading {info.filename}: {e}")
+            items.append((info.filename, language, data, info.file_size))
+        return items
+    
+    def _classify_member(self, name: str) -> Optional[str]:
+        """Language of a zip member, or None if it lives in an ignored directory or should be skipped"""
+        parts = name.split('/')
+        if any(part in self.IGNORE_PATTERNS for part in parts[:-1]):
+            return None
+        return self._classify(parts[-1])
+    
+    def _classify(self, name: str) -> Optional[str]:
+        """Language for a file name, or None if its extension is skipped.
+        
+        Plain string ops on the bare name, so the walkers never build a Path
+        or look the extension up twice.
+        """
+        dot = name.rfind('.')
+        if dot < 0:
+            return 'text'
+        ext = name[dot:].lower()
+        if ext in self.SKIP_EXTENSIONS:
+            return None
+        return self.LANGUAGE_MAP.get(ext, 'text')
     
     def get_language(self, file_path: str) -> str:
         """Determine language from file extension"""
@@ -112,257 +332,645 @@ class CodeParser:
         return self.LANGUAGE_MAP.get(ext, 'text')
     
     def parse_repository(self, repo_path: str) -> List[CodeChunk]:
-        """Parse entire repository into chunks"""
-        chunks = []
-        repo_path = Path(repo_path)
+        """Parse entire repository into a list of chunks"""
+        return list(self.iter_chunks(repo_path))
+    
+    def parse_repository_columns(self, repo_path: str) -> ChunkTable:
+        """Parse entire repository into a column-oriented ChunkTable"""
+        table = ChunkTable()
+        for chunk in self.iter_chunks(repo_path):
+            table.append(chunk)
+        return table
+    
+    def iter_chunks(self, repo_path: str) -> Iterator[CodeChunk]:
+        """Yield chunks as files are parsed, so callers can index while the walk continues"""
+        files = self._iter_files(repo_path)
+        head = list(itertools.islice(files, self.PARALLEL_MIN_FILES))
         
-        # Walk through all files
-        for file_path in repo_path.rglob('*'):
-            if not file_path.is_file():
-                continue
-            
-            # Skip ignored paths and extensions
-            if self.should_ignore(file_path):
-                continue
-            
-            if file_path.suffix.lower() in self.SKIP_EXTENSIONS:
-                continue
-            
-            # Get relative path from repo root
-            try:
-                rel_path = file_path.relative_to(repo_path)
-            except ValueError:
-                continue
-            
-            # Parse the file
-            file_chunks = self.parse_file(str(file_path), str(rel_path))
-            chunks.extend(file_chunks)
+        if len(head) < self.PARALLEL_MIN_FILES or self.max_workers == 1:
+            for file_path, rel_path, language in itertools.chain(head, files):
+                yield from self.parse_file(file_path, rel_path, language)
+            return
         
-        return chunks
+        # Parsing is CPU-bound, so fan batches of files out across worker
+        # processes, keeping only a bounded number in flight (backpressure)
+        settings = self._settings()
+        batches = _batched(itertools.chain(head, files), self.PARALLEL_BATCH_SIZE)
+        for batch_chunks in _ordered_results(
+                self.start_pool(), _parse_files_worker,
+                ((batch, settings) for batch in batches),
+                window=self.max_workers * 2):
+            yield from batch_chunks
+    
+    def start_pool(self) -> ProcessPoolExecutor:
+        """Return the shared worker pool, creating it on first use.
+        
+        One pool serves every upload, so processes start once rather than per
+        parse and concurrent uploads share max_workers processes. Workers come
+        from a forkserver (spawn where unavailable): parses are started from
+        threads of a multi-threaded server, and a plain fork there can copy a
+        lock some other thread holds and deadlock the child. Either way each
+        worker re-imports the launching script as __mp_main__, so that script
+        should be cheap to import (`uvicorn main:app`, not `python main.py`).
+        """
+        with self._pool_lock:
+            if self._pool is None:
+                if 'forkserver' in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context('forkserver')
+                    # Imported once in the server, not in every worker
+                    context.set_forkserver_preload([__name__])
+                else:
+                    context = multiprocessing.get_context('spawn')
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=context)
+            return self._pool
+    
+    def close_pool(self):
+        """Shut the shared worker pool down; a later parse starts a new one"""
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+    
+    def _settings(self) -> tuple:
+        """Everything a worker process needs to rebuild an equivalent parser"""
+        return (self.max_chunk_size, self.overlap, self.cache_dir, self.max_file_bytes)
+    
+    def settings_key(self) -> str:
+        """Identifies the chunk output: parsers with equal keys chunk any archive the same"""
+        mode = ','.join(sorted(self._languages)) or 're'
+        return (f"{self.CHUNKER_VERSION}:{mode}:{self.max_chunk_size}:"
+                f"{self.overlap}:{self.max_file_bytes}")
+    
+    def _iter_files(self, repo_path: str, rel_dir: str = '') -> Iterator[Tuple[str, str, str]]:
+        """Yield (absolute path, path relative to repo root, language) for each parseable file.
+        
+        Ignored directories are pruned before descending, so trees like
+        node_modules/ or .git/ are never listed at all.
+        """
+        try:
+            it = os.scandir(repo_path)
+        except OSError as e:
+            print(f"Error listing {repo_path}: {e}")
+            return
+        
+        with it:
+            for entry in it:
+                name = entry.name
+                rel_path = os.path.join(rel_dir, name) if rel_dir else name
+                
+                if entry.is_dir(follow_symlinks=False):
+                    if name in self.IGNORE_PATTERNS:
+                        continue
+                    yield from self._iter_files(entry.path, rel_path)
+                
+                elif entry.is_file(follow_symlinks=False):
+                    language = self._classify(name)
+                    if language is not None:
+                        yield entry.path, rel_path, language
     
-    def parse_file(self, file_path: str, rel_path: str) -> List[CodeChunk]:
+    def parse_file(self, file_path: str, rel_path: str, language: str = None) -> List[CodeChunk]:
         """Parse a single file into chunks"""
+        if language is None:
+            language = self.get_language(file_path)
+        
         try:
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
+            with open(file_path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size > self.max_file_bytes:
+                    return [self._skipped_large(rel_path, language, size)]
+                data = f.read()
         except Exception as e:
             print(f"Error reading {file_path}: {e}")
             return []
         
-        if not content.strip():
+        return self._chunk_bytes(data, rel_path, language)
+    
+    def _skipped_large(self, rel_path: str, language: str, size: int) -> CodeChunk:
+        """Placeholder chunk for an oversized file, so it stays findable by path"""
+        print(f"Skipping {rel_path}: {size} bytes exceeds {self.max_file_bytes}")
+        return CodeChunk(
+            content=f"{rel_path} ({language}, {size} bytes) was too large to index",
+            file_path=rel_path,
+            start_line=1,
+            end_line=1,
+            language=language,
+            chunk_type="skipped_large"
+        )
+    
+    def _chunk_bytes(self, data: bytes, rel_path: str, language: str) -> List[CodeChunk]:
+        """Chunk file contents, reusing cached chunks for content seen before"""
+        # Chunkers work on raw bytes; text is only decoded per emitted chunk
+        if self.BINARY_SNIFF in data[:self.BINARY_SNIFF_BYTES] or not data.strip():
             return []
         
-        language = self.get_language(file_path)
+        if self.cache_dir is None:
+            return self._chunk_uncached(data, rel_path, language)
         
-        # Try semantic chunking first (for supported languages)
-        if language == 'python':
-            return self.chunk_python(content, rel_path, language)
-        elif language in ['javascript', 'typescript']:
-            return self.chunk_javascript(content, rel_path, language)
-        else:
-            # Fallback to simple chunking
-            return self.chunk_by_lines(content, rel_path, language)
-    
-    def chunk_python(self, content: str, file_path: str, language: str) -> List[CodeChunk]:
-        """Chunk Python code by functions and classes"""
+        cache_path = self._cache_path(data, language)
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                chunks = [CodeChunk(file_path=rel_path, **d) for d in json.load(f)]
+            # Mark as recently used, so prune_cache keeps it
+            os.utime(cache_path)
+            return chunks
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Ignoring unreadable parse cache {cache_path}: {e}")
+        
+        chunks = self._chunk_uncached(data, rel_path, language)
+        self._write_cache(cache_path, chunks)
+        return chunks
+    
+    def _cache_path(self, data: bytes, language: str) -> Path:
+        """Cache file for this content under the current chunking settings"""
+        mode = 'ast' if language in self._languages else 're'
+        h = hashlib.blake2b(
+            f"{self.CHUNKER_VERSION}:{language}:{mode}:{self.max_chunk_size}:{self.overlap}:".encode(),
+            digest_size=16
+        )
+        h.update(data)
+        digest = h.hexdigest()
+        return self.cache_dir / digest[:2] / f"{digest}.json"
+    
+    def _write_cache(self, cache_path: Path, chunks: List[CodeChunk]):
+        """Atomically store chunks (minus file_path, which is per-use) in the cache"""
+        payload = []
+        for chunk in chunks:
+            d = chunk.to_dict()
+            del d['file_path']
+            payload.append(d)
+        
+        tmp_path = None
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=cache_path.parent,
+                                             suffix='.tmp', delete=False) as tmp:
+                json.dump(payload, tmp)
+                tmp_path = tmp.name
+            os.replace(tmp_path, cache_path)
+        except Exception as e:
+            print(f"Error writing parse cache {cache_path}: {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+    
+    def prune_cache(self, max_age_seconds: float) -> int:
+        """Delete cache entries not written or read for max_age_seconds; returns how many"""
+        if self.cache_dir is None or not self.cache_dir.is_dir():
+            return 0
+        cutoff = time.time() - max_age_seconds
+        removed = 0
+        for path in self.cache_dir.glob('*/*'):
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+    
+    def _chunk_uncached(self, data: bytes, rel_path: str, language: str) -> List[CodeChunk]:
+        """Dispatch to the chunker for this language"""
+        return self._chunkers.get(language, self.chunk_by_lines)(data, rel_path, language)
+    
+    def _get_parser(self, language: str):
+        """Return this thread's parser for a language, creating it on first use"""
+        parser = getattr(self._local, language, None)
+        if parser is None:
+            parser = Parser()
+            parser.set_language(self._languages[language])
+            setattr(self._local, language, parser)
+        return parser
+
+    def _chunk_ast(self, data: bytes, file_path: str, language: str) -> List[CodeChunk]:
+        """Chunk code along tree-sitter AST node boundaries (split-then-merge)"""
+        if len(data) <= self.max_chunk_size:
+            return [CodeChunk(
+                content=_decode(data),
+                file_path=file_path,
+                start_line=1,
+                end_line=data.count(b'\n') + 1,
+                language=language,
+                chunk_type="file"
+            )]
+
+        try:
+            tree = self._get_parser(language).parse(data)
+        except Exception as e:
+            print(f"Error parsing {file_path}: {e}")
+            return self.chunk_by_lines(data, file_path, language)
+
+        spans = self._split_node(tree.root_node, data, 0, len(data))
+
+        # Start each chunk at the beginning of its first line when only
+        # indentation precedes it there, so methods keep their shape
+        for prev, span in zip(spans, spans[1:]):
+            line_start = data.rfind(b'\n', 0, span[0]) + 1
+            if line_start > prev[0] and not data[line_start:span[0]].strip():
+                prev[1] = span[0] = line_start
+
+        offsets = self._line_offsets(data)
         chunks = []
-        lines = content.split('\n')
+        for start, end, nodes, opaque in spans:
+            text = data[start:end]
+            if not text.strip():
+                continue
+            if opaque and end - start > self.max_chunk_size:
+                # A huge string or comment: window it like any other text
+                line_base = bisect_right(offsets, start) - 1
+                for chunk in self.chunk_by_lines(text, file_path, language):
+                    chunk.start_line += line_base
+                    chunk.end_line += line_base
+                    chunks.append(chunk)
+                continue
+            # Spans run up to the next node, so trim the whitespace between them
+            lead = self._LEADING_BLANK_LINES.match(text).end()
+            text = text[lead:].rstrip()
+            start_line = bisect_right(offsets, start + lead)
+            chunks.append(CodeChunk(
+                content=_decode(text),
+                file_path=file_path,
+                start_line=start_line,
+                end_line=start_line + text.count(b'\n'),
+                language=language,
+                chunk_type=self._ast_chunk_type(nodes)
+            ))
+
+        if not chunks:
+            return self.chunk_by_lines(data, file_path, language)
+        return chunks
+
+    def _split_node(self, node, data: bytes, start: int, end: int) -> list:
+        """Cover data[start:end] with [start, end, nodes, opaque] spans (split-then-merge).
         
-        # Pattern to match function/class definitions
-        func_pattern = re.compile(r'^(def|class)\s+(\w+)')
+        Each child's span runs up to the next sibling's start, so text between
+        nodes always lands in some chunk. Oversized children are split in turn,
+        then adjacent spans are merged greedily up to the budget; near-empty
+        spans are folded once, at the end, so folds never pile up per level.
+        The descent uses an explicit stack: generated code like `1+1+...`
+        nests thousands of levels deep, far past Python's recursion limit.
+        """
+        # One frame per node being split: [children, next index, start, end, spans]
+        stack = [[node.children, 0, start, end, []]]
+        while True:
+            frame = stack[-1]
+            children, i, start, end, spans = frame
+            if i < len(children):
+                frame[1] = i + 1
+                child = children[i]
+                lo = start if i == 0 else child.start_byte
+                hi = children[i + 1].start_byte if i + 1 < len(children) else end
+                if hi - lo <= self.max_chunk_size:
+                    spans.append([lo, hi, [child], False])
+                elif child.child_count and child.type not in self.AST_OPAQUE_TYPES:
+                    stack.append([child.children, 0, lo, hi, []])
+                else:
+                    spans.append([lo, hi, [child], True])
+                continue
+            
+            stack.pop()
+            merged = self._merge_spans(spans)
+            if not stack:
+                return self._fold_small_spans(data, merged)
+            stack[-1][4].extend(merged)
+
+    def _merge_spans(self, spans: list) -> list:
+        """Greedily merge adjacent spans up to the budget"""
+        merged = []
+        for span in spans:
+            if merged and span[1] - merged[-1][0] <= self.max_chunk_size:
+                merged[-1][1] = span[1]
+                merged[-1][2].extend(span[2])
+            else:
+                merged.append(span)
+        return merged
+
+    def _fold_small_spans(self, data: bytes, spans: list) -> list:
+        """Attach near-empty spans to the span after them (the last one to the span before)"""
+        folded = []
+        carry = None
+        for span in spans:
+            if carry is not None:
+                # Keeps span's nodes, so a decorated function is still a function
+                span[0] = carry[0]
+                carry = None
+            if (span[1] - span[0] <= self.max_chunk_size
+                    and len(data[span[0]:span[1]].strip()) < self.AST_MIN_CHUNK):
+                carry = span
+            else:
+                folded.append(span)
+        if carry is not None:
+            if folded:
+                folded[-1][1] = carry[1]
+            else:
+                folded.append(carry)
+        return folded
+
+    def _ast_chunk_type(self, nodes: list) -> str:
+        """Label a merged span: a lone function/class keeps its kind"""
+        if len(nodes) != 1:
+            return "block"
+        node = nodes[0]
+        while node.type in self.AST_WRAPPER_TYPES:
+            inner = [c for c in node.named_children if c.type not in ('decorator', 'comment')]
+            if not inner:
+                break
+            node = inner[-1] if node.type == 'variable_declarator' else inner[0]
+        if node.type in self.AST_FUNCTION_TYPES:
+            return "function"
+        if node.type in self.AST_CLASS_TYPES:
+            return "class"
+        return "block"
+
+    @staticmethod
+    def _match_lines(pattern: 're.Pattern', data: bytes) -> List[int]:
+        """1-based numbers of the lines where a MULTILINE pattern matches, in order"""
+        lines = []
+        line, pos = 1, 0
+        for m in pattern.finditer(data):
+            line += data.count(b'\n', pos, m.start())
+            pos = m.start()
+            lines.append(line)
+        return lines
+    
+    @staticmethod
+    def _line_offsets(data: bytes) -> List[int]:
+        """Start offset of every line, plus a sentinel one past the end.
+        
+        Lines a..b (1-based, inclusive) are data[offsets[a-1]:offsets[b] - 1],
+        which equals b'\n'.join(lines[a-1:b]) without splitting the file.
+        """
+        offsets = [0]
+        i = data.find(b'\n')
+        while i >= 0:
+            offsets.append(i + 1)
+            i = data.find(b'\n', i + 1)
+        offsets.append(len(data) + 1)
+        return offsets
+    
+    def _emit_lines(self, chunks: List[CodeChunk], data: bytes, offsets: List[int],
+                    start: int, end: int, file_path: str, language: str, chunk_type: str):
+        """Append lines start..end as a chunk, unless they are blank"""
+        chunk_content = data[offsets[start - 1]:offsets[end] - 1]
+        if chunk_content.strip():
+            chunks.append(CodeChunk(
+                content=_decode(chunk_content),
+                file_path=file_path,
+                start_line=start,
+                end_line=end,
+                language=language,
+                chunk_type=chunk_type
+            ))
+    
+    def chunk_python(self, data: bytes, file_path: str, language: str) -> List[CodeChunk]:
+        """Chunk Python code by functions and classes"""
+        chunks = []
+        offsets = self._line_offsets(data)
+        total_lines = len(offsets) - 1
         
-        current_chunk = []
         current_start = 1
+        current_type = "block"
         indent_level = 0
         in_definition = False
         
-        for i, line in enumerate(lines, 1):
-            stripped = line.lstrip()
+        # Chunk boundaries can only fall on definition lines, so visit just those
+        for i in self._match_lines(self._PY_DEF_SCAN, data):
+            line = data[offsets[i - 1]:offsets[i] - 1]
+            stripped = line.lstrip(b' ')
+            indent = len(line) - len(stripped)
             
-            # Check if this is a function or class definition
-            match = func_pattern.match(stripped)
+            if not in_definition:
+                # Save the preamble before the first definition
+                if i > current_start:
+                    self._emit_lines(chunks, data, offsets, current_start, i - 1,
+                                     file_path, language, "block")
             
-            if match and not in_definition:
-                # Save previous chunk if it exists
-                if current_chunk:
-                    chunk_content = '\n'.join(current_chunk)
-                    if chunk_content.strip():
-                        chunks.append(CodeChunk(
-                            content=chunk_content,
-                            file_path=file_path,
-                            start_line=current_start,
-                            end_line=i - 1,
-                            language=language,
-                            chunk_type="block"
-                        ))
-                
-                # Start new chunk
-                current_chunk = [line]
-                current_start = i
-                in_definition = True
-                indent_level = len(line) - len(stripped)
+            # A definition at the same or lower indent ends the current one
+            elif indent <= indent_level and i > current_start:
+                self._emit_lines(chunks, data, offsets, current_start, i - 1,
+                                 file_path, language, current_type)
             
-            elif in_definition:
-                current_chunk.append(line)
-                
-                # Check if we've left the definition (unindent or empty line followed by new def)
-                if stripped and not line.startswith(' ' * (indent_level + 1)) and i > current_start:
-                    # Check if next line is a new definition at same level
-                    if func_pattern.match(stripped):
-                        # End current chunk (don't include this line)
-                        chunk_content = '\n'.join(current_chunk[:-1])
-                        if chunk_content.strip():
-                            chunks.append(CodeChunk(
-                                content=chunk_content,
-                                file_path=file_path,
-                                start_line=current_start,
-                                end_line=i - 1,
-                                language=language,
-                                chunk_type=current_chunk[0].strip().split()[0]
-                            ))
-                        
-                        # Start new chunk with this line
-                        current_chunk = [line]
-                        current_start = i
-                        indent_level = len(line) - len(stripped)
             else:
-                current_chunk.append(line)
+                continue
+            
+            # Start new chunk with this line
+            current_start = i
+            current_type = stripped.split(None, 1)[0].decode()
+            in_definition = True
+            indent_level = indent
         
         # Add final chunk
-        if current_chunk:
-            chunk_content = '\n'.join(current_chunk)
-            if chunk_content.strip():
-                chunks.append(CodeChunk(
-                    content=chunk_content,
-                    file_path=file_path,
-                    start_line=current_start,
-                    end_line=len(lines),
-                    language=language,
-                    chunk_type="block"
-                ))
+        self._emit_lines(chunks, data, offsets, current_start, total_lines,
+                         file_path, language, "block")
         
         # If no semantic chunks found or file is small, return whole file
-        if not chunks or len(chunks) == 1 and len(content) < self.max_chunk_size:
+        if not chunks or len(chunks) == 1 and len(data) < self.max_chunk_size:
             return [CodeChunk(
-                content=content,
+                content=_decode(data),
                 file_path=file_path,
                 start_line=1,
-                end_line=len(lines),
+                end_line=total_lines,
                 language=language,
                 chunk_type="file"
             )]
         
         return chunks
     
-    def chunk_javascript(self, content: str, file_path: str, language: str) -> List[CodeChunk]:
+    def chunk_javascript(self, data: bytes, file_path: str, language: str) -> List[CodeChunk]:
         """Chunk JavaScript/TypeScript code by functions"""
         chunks = []
-        lines = content.split('\n')
-        
-        # Pattern for function declarations
-        func_pattern = re.compile(r'^\s*(export\s+)?(async\s+)?(function|const|let|var)\s+\w+')
-        class_pattern = re.compile(r'^\s*(export\s+)?(default\s+)?class\s+\w+')
+        offsets = self._line_offsets(data)
+        total_lines = len(offsets) - 1
+        def_lines = set(self._match_lines(self._JS_DEF_SCAN, data))
         
-        current_chunk = []
         current_start = 1
         brace_count = 0
+        saw_open_brace = False
         in_definition = False
         
-        for i, line in enumerate(lines, 1):
-            if func_pattern.match(line) or class_pattern.match(line):
-                if current_chunk and not in_definition:
-                    chunk_content = '\n'.join(current_chunk)
-                    if chunk_content.strip():
-                        chunks.append(CodeChunk(
-                            content=chunk_content,
-                            file_path=file_path,
-                            start_line=current_start,
-                            end_line=i - 1,
-                            language=language,
-                            chunk_type="block"
-                        ))
+        for i in range(1, total_lines + 1):
+            line_start, line_end = offsets[i - 1], offsets[i] - 1
+            opens = data.count(b'{', line_start, line_end)
+            closes = data.count(b'}', line_start, line_end)
+            
+            if i in def_lines:
+                if i > current_start and not in_definition:
+                    self._emit_lines(chunks, data, offsets, current_start, i - 1,
+                                     file_path, language, "block")
                 
-                current_chunk = [line]
                 current_start = i
                 in_definition = True
-                brace_count = line.count('{') - line.count('}')
-            else:
-                current_chunk.append(line)
-                if in_definition:
-                    brace_count += line.count('{') - line.count('}')
-                    if brace_count == 0 and '{' in ''.join(current_chunk):
-                        # End of function/class
-                        chunk_content = '\n'.join(current_chunk)
-                        if chunk_content.strip():
-                            chunks.append(CodeChunk(
-                                content=chunk_content,
-                                file_path=file_path,
-                                start_line=current_start,
-                                end_line=i,
-                                language=language,
-                                chunk_type="function"
-                            ))
-                        current_chunk = []
-                        current_start = i + 1
-                        in_definition = False
+                brace_count = opens - closes
+                saw_open_brace = opens > 0
+            elif in_definition:
+                brace_count += opens - closes
+                saw_open_brace = saw_open_brace or opens > 0
+                if brace_count == 0 and saw_open_brace:
+                    # End of function/class
+                    self._emit_lines(chunks, data, offsets, current_start, i,
+                                     file_path, language, "function")
+                    current_start = i + 1
+                    in_definition = False
         
         # Add final chunk
-        if current_chunk:
-            chunk_content = '\n'.join(current_chunk)
-            if chunk_content.strip():
-                chunks.append(CodeChunk(
-                    content=chunk_content,
-                    file_path=file_path,
-                    start_line=current_start,
-                    end_line=len(lines),
-                    language=language,
-                    chunk_type="block"
-                ))
+        if current_start <= total_lines:
+            self._emit_lines(chunks, data, offsets, current_start, total_lines,
+                             file_path, language, "block")
         
         if not chunks:
             return [CodeChunk(
-                content=content,
+                content=_decode(data),
                 file_path=file_path,
                 start_line=1,
-                end_line=len(lines),
+                end_line=total_lines,
                 language=language,
                 chunk_type="file"
             )]
         
         return chunks
     
-    def chunk_by_lines(self, content: str, file_path: str, language: str) -> List[CodeChunk]:
-        """Fallback: chunk by lines with overlap"""
-        lines = content.split('\n')
+    def chunk_by_lines(self, data: bytes, file_path: str, language: str) -> List[CodeChunk]:
+        """Fallback: chunk into windows of at most max_chunk_size bytes, with overlap.
+        
+        Windows end on a line break when one falls inside the budget, so a single
+        200KB minified line is still split while ordinary code keeps whole lines.
+        """
+        total = len(data)
         chunks = []
         
-        if len(lines) <= self.max_chunk_size:
+        if total <= self.max_chunk_size:
             # Small file, return as single chunk
             return [CodeChunk(
-                content=content,
+                content=_decode(data),
                 file_path=file_path,
                 start_line=1,
-                end_line=len(lines),
+                end_line=data.count(b'\n') + 1,
                 language=language,
                 chunk_type="file"
             )]
         
-        # Chunk with overlap
-        i = 0
-        while i < len(lines):
-            end = min(i + self.max_chunk_size, len(lines))
-            chunk_lines = lines[i:end]
+        start = 0
+        start_line, counted_to = 1, 0
+        while start < total:
+            end = min(start + self.max_chunk_size, total)
+            if end < total:
+                newline = data.rfind(b'\n', start, end)
+                if newline >= start:
+                    end = newline + 1
+                else:
+                    end = _utf8_boundary(data, end, start)
             
-            chunks.append(CodeChunk(
-                content='\n'.join(chunk_lines),
-                file_path=file_path,
-                start_line=i + 1,
-                end_line=end,
-                language=language,
-                chunk_type="block"
-            ))
+            # Line numbers are counted incrementally, so the whole walk stays O(n)
+            start_line += data.count(b'\n', counted_to, start)
+            counted_to = start
+            text = data[start:end]
+            if text.endswith(b'\n'):
+                text = text[:-1]
             
-            # Move forward with overlap
-            i += self.max_chunk_size - self.overlap
+            if text.strip():
+                chunks.append(CodeChunk(
+                    content=_decode(text),
+                    file_path=file_path,
+                    start_line=start_line,
+                    end_line=start_line + text.count(b'\n'),
+                    language=language,
+                    chunk_type="block"
+                ))
+            
+            if end >= total:
+                break
+            
+            # Move forward with overlap, restarting at a line boundary if possible
+            next_start = end - self.overlap
+            if next_start <= start:
+                next_start = end
+            else:
+                newline = data.find(b'\n', next_start - 1, end - 1)
+                if newline >= 0:
+                    next_start = newline + 1
+                elif data[end - 1] == 0x0A:
+                    next_start = end
+                else:
+                    next_start = _utf8_boundary(data, next_start, start)
+            start = next_start
         
-        return chunks
\ No newline at end of file
+        return chunks
+
+
+_worker_parser = None
+
+
+def _get_worker_parser(settings: tuple) -> 'CodeParser':
+    """This worker process's CodeParser, rebuilt only when the settings change"""
+    global _worker_parser
+    if _worker_parser is None or _worker_parser._settings() != settings:
+        max_chunk_size, overlap, cache_dir, max_file_bytes = settings
+        _worker_parser = CodeParser(max_chunk_size=max_chunk_size, overlap=overlap,
+                                    max_workers=1, cache_dir=cache_dir,
+                                    max_file_bytes=max_file_bytes)
+    return _worker_parser
+
+
+def _parse_files_worker(batch: List[Tuple[str, str, str]], settings: tuple) -> List[CodeChunk]:
+    """Process-pool entry point: parse a batch of files with a per-process CodeParser"""
+    parser = _get_worker_parser(settings)
+    chunks = []
+    for file_path, rel_path, language in batch:
+        chunks.extend(parser.parse_file(file_path, rel_path, language))
+    return chunks
+
+
+def _chunk_members_worker(members: List[tuple], settings: tuple) -> List[CodeChunk]:
+    """Process-pool entry point: chunk a batch of zip members read by _read_members"""
+    parser = _get_worker_parser(settings)
+    chunks = []
+    for name, language, data, size in members:
+        if size > parser.max_file_bytes:
+            chunks.append(parser._skipped_large(name, language, size))
+        elif data is not None:
+            chunks.extend(parser._chunk_bytes(data, name, language))
+    return chunks
+
+
+def _ordered_results(executor: Executor, fn, arg_tuples: Iterable[tuple],
+                     window: int) -> Iterator:
+    """Like executor.map, but submits lazily with at most `window` calls in flight"""
+    pending = deque()
+    for args in arg_tuples:
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _batched(items: Iterable, size: int) -> Iterator[list]:
+    """Group an iterable into lists of at most `size` items"""
+    it = iter(items)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _decode(data: bytes) -> str:
+    """Decode chunk bytes for storage; undecodable bytes become U+FFFD"""
+    return data.decode('utf-8', errors='replace')
+
+
+def _utf8_boundary(data: bytes, pos: int, floor: int) -> int:
+    """Nearest character start to pos, so a cut never splits a UTF-8 sequence.
+    
+    Searches backwards first, but never down to floor, so the caller always
+    makes progress; if that fails it moves forwards instead.
+    """
+    back = pos
+    while back > floor and data[back] & 0xC0 == 0x80:
+        back -= 1
+    if back > floor:
+        return back
+    while pos < len(data) and data[pos] & 0xC0 == 0x80:
+        pos += 1
+    return pos
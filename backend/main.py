@@ -6,25 +6,66 @@ v1.1 — Adds GitHub URL upload, cleans duplicate code.
 
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import chromadb
+from chromadb.utils import embedding_functions
 import anthropic
 import os
+import asyncio
 import uuid
-import sqlite3
+import hashlib
 import tempfile
-import shutil
 import json
+import itertools
+import re
+import threading
 import time
 import traceback
-from typing import List, Optional
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from operator import attrgetter
+from typing import BinaryIO, List, Optional, Union
+import aiosqlite
+from aiosqlitepool import SQLiteConnectionPool
 from code_parser import CodeParser
+from query_cache import QueryCache, PersistentQueryCache, is_missing_collection
 import httpx
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI(title="Code Repository Q&A API")
+
+# ── Lifespan ──────────────────────────────────────────────────────────────────
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global metrics_pool, claude_semaphore
+    metrics_pool = SQLiteConnectionPool(open_metrics_connection)
+    await init_metrics_db()
+    # Created here, on the serving loop (Python 3.9 binds it at construction)
+    claude_semaphore = asyncio.Semaphore(CLAUDE_MAX_CONCURRENCY)
+    # Worker processes start once here and serve every upload
+    code_parser.start_pool()
+    # The parse cache would otherwise grow forever; prune it off the loop
+    asyncio.get_running_loop().run_in_executor(
+        None, code_parser.prune_cache, PARSE_CACHE_MAX_AGE
+    )
+    yield
+    await metrics_pool.close()
+    await anthropic_client.close()
+    await github_client.aclose()
+    index_executor.shutdown(wait=True)
+    code_parser.close_pool()
+
+
+app = FastAPI(
+    title="Code Repository Q&A API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -36,58 +77,268 @@ app.add_middleware(
 
 # ── ChromaDB ──────────────────────────────────────────────────────────────────
 CHROMA_PATH = os.environ.get("CHROMA_DB_PATH", "./chroma_db")
-chroma_client = chromadb.PersistentClient(path=CHROMA_PATH)
+CHROMA_HOST = os.environ.get("CHROMA_HOST")
+if CHROMA_HOST:
+    # Server-mode Chroma: the index lives out of process, so API workers stay
+    # light and several of them can share one store
+    chroma_client = chromadb.HttpClient(
+        host=CHROMA_HOST,
+        port=int(os.environ.get("CHROMA_PORT", "8001"))
+    )
+else:
+    chroma_client = chromadb.PersistentClient(path=CHROMA_PATH)
+# all-MiniLM-L6-v2 (ONNX), the model collections have always been embedded
+# with; loaded once and used explicitly for both indexing and queries
+embedding_function = embedding_functions.DefaultEmbeddingFunction()
+
+# Per-repo caches are LRU-bounded, so repos nobody queries any more release
+# their handles and listings instead of accumulating for the process lifetime
+REPO_CACHE_SIZE = 64
+repo_cache_lock = threading.Lock()
+
+
+def lru_get(cache: OrderedDict, key: str):
+    with repo_cache_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+
+def lru_put(cache: OrderedDict, key: str, value):
+    with repo_cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > REPO_CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+def lru_pop(cache: OrderedDict, key: str):
+    with repo_cache_lock:
+        cache.pop(key, None)
+
+
+def evict_repo(repo_id: str):
+    """Drop everything this process caches for a repo that no longer exists"""
+    lru_pop(collection_cache, repo_id)
+    lru_pop(repo_files_cache, repo_id)
+    query_cache.invalidate_repo(repo_id)
+
+
+# repo_id -> Collection handle, so queries skip the metadata lookup in
+# get_collection; entries are dropped when the repo is deleted
+collection_cache: "OrderedDict[str, chromadb.Collection]" = OrderedDict()
+
+# With CHROMA_HOST, several workers share one store and any of them may delete
+# a repo, which this process's caches never hear about; so cached handles are
+# not trusted and cached answers are only served once the repo is confirmed
+SHARED_CHROMA = bool(CHROMA_HOST)
+
+
+def get_repo_collection(repo_id: str) -> chromadb.Collection:
+    """Collection for a repo, resolved through Chroma only on first use.
+    
+    Against a shared Chroma it is resolved on every call instead, and fails
+    once another worker has deleted the repo.
+    """
+    if not SHARED_CHROMA:
+        collection = lru_get(collection_cache, repo_id)
+        if collection is not None:
+            return collection
+    try:
+        collection = chroma_client.get_collection(name=f"repo_{repo_id}")
+    except Exception as e:
+        if is_missing_collection(e):
+            evict_repo(repo_id)
+        raise
+    lru_put(collection_cache, repo_id, collection)
+    return collection
+
+
+# ── Reranker (optional) ───────────────────────────────────────────────────────
+# Set RERANK_MODEL (e.g. BAAI/bge-reranker-base) with sentence-transformers
+# installed to rerank a wider ANN candidate set before building the prompt
+RERANK_MODEL = os.environ.get("RERANK_MODEL")
+RERANK_CANDIDATE_FACTOR = 4  # ANN candidates fetched per result kept
+reranker = None
+if RERANK_MODEL:
+    # Imported only when enabled: sentence-transformers pulls in torch
+    try:
+        from sentence_transformers import CrossEncoder
+    except ImportError:
+        print("RERANK_MODEL is set but sentence-transformers is not installed; reranking disabled")
+    else:
+        reranker = CrossEncoder(RERANK_MODEL)
 
 # ── Anthropic ─────────────────────────────────────────────────────────────────
-anthropic_client = anthropic.Anthropic(
+# Async client so the event loop keeps serving requests while Claude answers;
+# the SDK retries 429/5xx responses itself with exponential backoff
+anthropic_client = anthropic.AsyncAnthropic(
     api_key=os.getenv("ANTHROPIC_API_KEY"),
-    http_client=httpx.Client()
+    max_retries=4,
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+    )
 )
 
+# Caps concurrent Claude calls to stay under the account's rate limits
+CLAUDE_MAX_CONCURRENCY = 8
+claude_semaphore: Optional[asyncio.Semaphore] = None
+
 # ── Code Parser ───────────────────────────────────────────────────────────────
-code_parser = CodeParser(max_chunk_size=100, overlap=10)
+code_parser = CodeParser(
+    max_chunk_size=4000,  # bytes per chunk
+    overlap=400,
+    cache_dir=os.environ.get("PARSE_CACHE_DIR", "./parse_cache")
+)
+# Cached chunks unused for this long are deleted at startup
+PARSE_CACHE_MAX_AGE = float(os.environ.get("PARSE_CACHE_MAX_AGE_DAYS", "30")) * 24 * 3600
+
+# ── Query Cache ───────────────────────────────────────────────────────────────
+query_cache = QueryCache(max_size=1000, ttl_seconds=3600, threshold=0.95)
+# Backed by Chroma, so answers outlive restarts and are shared across workers
+persistent_query_cache = PersistentQueryCache(chroma_client, ttl_seconds=24 * 3600, threshold=0.95)
+
+# Per-repo file listings; a repo's chunks never change after indexing, so
+# entries only go away when the repo is deleted or falls out of the LRU
+repo_files_cache: "OrderedDict[str, dict]" = OrderedDict()
 
 
 # ── Metrics DB ────────────────────────────────────────────────────────────────
-def init_metrics_db():
-    conn = sqlite3.connect('metrics.db')
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS query_metrics (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            repo_id TEXT NOT NULL,
-            question TEXT NOT NULL,
-            response_time REAL NOT NULL,
-            tokens_used INTEGER NOT NULL,
-            files_queried TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+METRICS_DB = 'metrics.db'
+
+# Long-lived connections, so WAL state and page cache stay warm between
+# requests; created in lifespan()
+metrics_pool: Optional[SQLiteConnectionPool] = None
+
+
+async def open_metrics_connection() -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(METRICS_DB, timeout=10)
+    await conn.execute('PRAGMA journal_mode=WAL')
+    await conn.execute('PRAGMA synchronous=NORMAL')
+    await conn.execute('PRAGMA cache_size=-20000')
+    await conn.execute('PRAGMA temp_store=MEMORY')
+    conn.row_factory = aiosqlite.Row
+    return conn
+
+
+async def init_metrics_db():
+    async with metrics_pool.connection() as conn:
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS query_metrics (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                repo_id TEXT NOT NULL,
+                question TEXT NOT NULL,
+                response_time REAL NOT NULL,
+                tokens_used INTEGER NOT NULL,
+                files_queried TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS query_ratings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                query_id INTEGER NOT NULL,
+                rating INTEGER NOT NULL,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (query_id) REFERENCES query_metrics (id)
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS file_access (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                repo_id TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                access_count INTEGER DEFAULT 1,
+                last_accessed DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS query_files (
+                query_id INTEGER NOT NULL,
+                file_path TEXT NOT NULL,
+                FOREIGN KEY (query_id) REFERENCES query_metrics (id)
+            )
+        ''')
+        async with conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_file_access_repo_file'"
+        ) as c:
+            has_unique_index = await c.fetchone() is not None
+        if not has_unique_index:
+            # Rows written before the index existed can repeat a (repo, file)
+            # pair; fold them into the oldest row so the index can be built
+            await conn.execute('''
+                UPDATE file_access SET
+                    access_count = (SELECT SUM(f.access_count) FROM file_access f
+                                    WHERE f.repo_id = file_access.repo_id
+                                      AND f.file_path = file_access.file_path),
+                    last_accessed = (SELECT MAX(f.last_accessed) FROM file_access f
+                                     WHERE f.repo_id = file_access.repo_id
+                                       AND f.file_path = file_access.file_path)
+                WHERE id IN (SELECT MIN(id) FROM file_access GROUP BY repo_id, file_path)
+            ''')
+            await conn.execute('''
+                DELETE FROM file_access
+                WHERE id NOT IN (SELECT MIN(id) FROM file_access GROUP BY repo_id, file_path)
+            ''')
+            await conn.execute(
+                'CREATE UNIQUE INDEX idx_file_access_repo_file ON file_access (repo_id, file_path)'
+            )
+        # Back the ORDER BY ... LIMIT queries in /metrics and rating lookups
+        await conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_query_metrics_timestamp ON query_metrics (timestamp DESC)'
+        )
+        await conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_file_access_count ON file_access (access_count DESC)'
         )
-    ''')
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS query_ratings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            query_id INTEGER NOT NULL,
-            rating INTEGER NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (query_id) REFERENCES query_metrics (id)
+        await conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_query_ratings_query_id ON query_ratings (query_id)'
         )
-    ''')
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS file_access (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            repo_id TEXT NOT NULL,
-            file_path TEXT NOT NULL,
-            access_count INTEGER DEFAULT 1,
-            last_accessed DATETIME DEFAULT CURRENT_TIMESTAMP
+        await conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_query_files_query_id ON query_files (query_id)'
         )
-    ''')
-    conn.commit()
-    conn.close()
+        await conn.commit()
 
-init_metrics_db()
+
+async def record_query_metrics(repo_id: str, question: str, response_time: float,
+                               tokens_used: int, selected_files: Optional[List[str]]) -> Optional[int]:
+    """Save a query's metrics and return its id (non-critical — never crashes the query)."""
+    try:
+        async with metrics_pool.connection() as conn:
+            # One transaction, so the whole batch costs a single commit
+            await conn.execute('BEGIN IMMEDIATE')
+            async with conn.execute(
+                'INSERT INTO query_metrics '
+                '(repo_id, question, response_time, tokens_used) '
+                'VALUES (?, ?, ?, ?)',
+                (repo_id, question, response_time, tokens_used)
+            ) as c:
+                query_id = c.lastrowid
+            if selected_files:
+                # One row per file rather than a JSON blob, so it can be queried
+                await conn.executemany(
+                    'INSERT INTO query_files (query_id, file_path) VALUES (?, ?)',
+                    [(query_id, fp) for fp in selected_files]
+                )
+                await conn.executemany(
+                    'INSERT INTO file_access '
+                    '(repo_id, file_path, access_count, last_accessed) '
+                    'VALUES (?, ?, 1, CURRENT_TIMESTAMP) '
+                    'ON CONFLICT (repo_id, file_path) DO UPDATE SET '
+                    'access_count = access_count + 1, '
+                    'last_accessed = CURRENT_TIMESTAMP',
+                    [(repo_id, fp) for fp in selected_files]
+                )
+            await conn.commit()
+        return query_id
+    except Exception:
+        return None
 
 
 # ── TIPS Validation ───────────────────────────────────────────────────────────
+JUDGE_JSON_RE = re.compile(r'\{[^{}]+\}', re.DOTALL)
+
+
 async def tips_validate(question: str, answer: str, context: str) -> dict:
     """
     TIPS Framework — Claude Haiku judges Claude Sonnet's answer.
@@ -113,19 +364,19 @@ Respond with ONLY valid JSON, no other text:
 {{"score": <float 0.0-1.0>, "reasoning": "<one concise sentence explaining the score>"}}"""
 
     try:
-        response = anthropic_client.messages.create(
-            model="claude-haiku-4-5-20251001",
-            max_tokens=200,
-            messages=[{"role": "user", "content": judge_prompt}]
-        )
-        import json as _json, re as _re
+        async with claude_semaphore:
+            response = await anthropic_client.messages.create(
+                model="claude-haiku-4-5-20251001",
+                max_tokens=200,
+                messages=[{"role": "user", "content": judge_prompt}]
+            )
         raw = response.content[0].text.strip() if response.content else ""
         if not raw:
             raise ValueError("Empty response from judge model")
         # Extract JSON even if Haiku wraps it in text
-        match = _re.search(r'\{[^{}]+\}', raw, _re.DOTALL)
+        match = JUDGE_JSON_RE.search(raw)
         json_str = match.group() if match else raw
-        result = _json.loads(json_str)
+        result = json.loads(json_str)
         score = float(result.get("score", 0.75))
         score = max(0.0, min(1.0, score))
         level = "HIGH" if score >= 0.85 else "MEDIUM" if score >= 0.70 else "LOW"
@@ -173,6 +424,17 @@ class GitHubUploadRequest(BaseModel):
     branch: Optional[str] = None
 
 
+# ── GitHub Client ─────────────────────────────────────────────────────────────
+# Shared so archive downloads reuse pooled keep-alive connections instead of
+# a fresh TCP + TLS handshake per upload; closed in lifespan()
+github_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(60.0, connect=10.0),
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+    follow_redirects=True,
+    headers={"User-Agent": "code-repository-qa/1.1"}
+)
+
+
 # ── GitHub URL Parser ─────────────────────────────────────────────────────────
 def parse_github_url(url: str) -> tuple:
     """
@@ -208,68 +470,422 @@ def parse_github_url(url: str) -> tuple:
 
 
 # ── Shared indexing helper ────────────────────────────────────────────────────
-def index_zip(zip_path: str, display_name: str, extra_metadata: dict = None) -> dict:
+ADD_BATCH_SIZE = 2000  # chunks per collection.add call
+
+# Indexing is blocking (parse, embed, write), so it runs on its own threads;
+# the parser fans CPU work out further, so a couple of uploads at a time is plenty
+index_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="index")
+
+
+def add_batch(collection, documents: List[str], metadatas: List[dict], ids: List[str]):
+    """Embed a batch with the shared encoder in one call, then store it"""
+    # Vendored and copy-pasted code repeats chunk contents; encode each once
+    unique = list(dict.fromkeys(documents))
+    vectors = dict(zip(unique, embedding_function(unique)))
+    embeddings = [vectors[doc] for doc in documents]
+    collection.add(embeddings=embeddings, documents=documents, metadatas=metadatas, ids=ids)
+
+
+def hash_zip(zip_file: Union[str, BinaryIO]) -> str:
+    """sha256 of an archive (a path or seekable file), read in 1 MB blocks"""
+    if isinstance(zip_file, str):
+        with open(zip_file, 'rb') as f:
+            return hash_zip(f)
+    digest = hashlib.sha256()
+    for block in iter(partial(zip_file.read, 1 << 20), b''):
+        digest.update(block)
+    zip_file.seek(0)
+    return digest.hexdigest()
+
+
+def find_indexed_zip(zip_sha256: str, chunk_settings: str) -> Optional[chromadb.Collection]:
+    """Fully indexed repo collection built from an identical archive, if any.
+    
+    Only a collection chunked under the same parser settings counts: after a
+    chunker or chunk-size change the archive is indexed afresh.
+    """
+    for col in chroma_client.list_collections():
+        meta = col.metadata or {}
+        # chunk_count is only written once indexing has finished
+        if (col.name.startswith("repo_") and meta.get("zip_sha256") == zip_sha256
+                and meta.get("chunk_settings") == chunk_settings
+                and "chunk_count" in meta):
+            return col
+    return None
+
+
+def index_zip(zip_file: Union[str, BinaryIO], display_name: str,
+              extra_metadata: dict = None, zip_sha256: str = None) -> dict:
     """
-    Extract zip, parse code chunks, store in ChromaDB.
+    Parse code chunks straight out of the zip (a path or seekable file), store in ChromaDB.
+    An archive identical to one already indexed reuses that repository.
     Returns the upload response dict.
     Raises HTTPException on failure.
     """
-    extracted_dir = None
-    try:
-        extracted_dir = code_parser.extract_zip(zip_path)
-        chunks = code_parser.parse_repository(extracted_dir)
+    if zip_sha256 is None:
+        zip_sha256 = hash_zip(zip_file)
+    chunk_settings = code_parser.settings_key()
+    existing = find_indexed_zip(zip_sha256, chunk_settings)
+    if existing is not None:
+        repo_id = existing.name[len("repo_"):]
+        total = existing.metadata["chunk_count"]
+        print(f"Archive already indexed as {repo_id}, reusing it")
+        lru_put(collection_cache, repo_id, existing)
+        return {
+            "repo_id": repo_id,
+            "collection_name": existing.name,
+            "filename": existing.metadata.get("repo_name", display_name),
+            "status": "success",
+            "chunks_created": total,
+            "languages": json.loads(existing.metadata.get("lang_counts", "{}")),
+            "message": f"Repository already indexed — {total} code chunks."
+        }
 
-        if not chunks:
+    repo_id = str(uuid.uuid4())
+    collection_name = f"repo_{repo_id}"
+
+    metadata = {"repo_name": display_name, "zip_sha256": zip_sha256,
+                "chunk_settings": chunk_settings}
+    if extra_metadata:
+        metadata.update(extra_metadata)
+
+    collection = chroma_client.get_or_create_collection(
+        name=collection_name,
+        metadata=metadata
+    )
+
+    # Consume chunks as the parser yields them, handing them to Chroma in
+    # fixed-size batches so only one batch is ever held in memory. Each batch
+    # is split into columns with one comprehension per column
+    chunks = code_parser.parse_zip(zip_file)
+    lang_counts = Counter()
+    total = 0
+    try:
+        while True:
+            batch = list(itertools.islice(chunks, ADD_BATCH_SIZE))
+            if not batch:
+                break
+            documents = [c.content for c in batch]
+            metadatas = [
+                {
+                    "file_path": c.file_path,
+                    "start_line": c.start_line,
+                    "end_line": c.end_line,
+                    "language": c.language,
+                    "chunk_type": c.chunk_type
+                }
+                for c in batch
+            ]
+            ids = [f"{repo_id}_{i}" for i in range(total, total + len(batch))]
+            lang_counts.update(map(attrgetter("language"), batch))
+            add_batch(collection, documents, metadatas, ids)
+            total += len(batch)
+
+        if total == 0:
             raise HTTPException(
                 status_code=400,
                 detail="No code files found. Make sure the repository contains code files."
             )
+    except Exception:
+        # Don't leave an empty or half-indexed repository behind
+        chroma_client.delete_collection(name=collection_name)
+        raise
 
-        print(f"Found {len(chunks)} code chunks")
+    print(f"Indexed {total} code chunks")
+    # Record the totals on the collection, so /repos and /query read them
+    # back instead of counting chunks
+    collection.modify(metadata={
+        **metadata,
+        "chunk_count": total,
+        "lang_counts": json.dumps(dict(lang_counts))
+    })
+    lru_put(collection_cache, repo_id, collection)
 
-        repo_id = str(uuid.uuid4())
-        collection_name = f"repo_{repo_id}"
+    return {
+        "repo_id": repo_id,
+        "collection_name": collection_name,
+        "filename": display_name,
+        "status": "success",
+        "chunks_created": total,
+        "languages": dict(lang_counts),
+        "message": f"Repository indexed successfully — {total} code chunks."
+    }
+
+
+async def run_index_zip(zip_file: Union[str, BinaryIO], display_name: str,
+                        extra_metadata: dict = None, zip_sha256: str = None) -> dict:
+    """Run index_zip off the event loop so other requests are served meanwhile"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        index_executor,
+        partial(index_zip, zip_file, display_name, extra_metadata, zip_sha256)
+    )
 
-        metadata = {"repo_name": display_name}
-        if extra_metadata:
-            metadata.update(extra_metadata)
 
-        collection = chroma_client.get_or_create_collection(
-            name=collection_name,
-            metadata=metadata
+# ── Query pipeline ────────────────────────────────────────────────────────────
+# Upper bound on retrieved code sent to Claude per question. Estimated from
+# length, since exact counts would cost an API round-trip; code averages
+# fewer characters per token than prose, so the estimate errs high
+CONTEXT_TOKEN_BUDGET = 8000
+CHARS_PER_TOKEN = 3
+
+
+async def retrieve_for_query(request: QueryRequest) -> tuple:
+    """
+    Cache lookups, then semantic retrieval for a query.
+    Returns (cached_response, None, [], []) on a cache hit, otherwise
+    (None, question_embedding, documents, metadatas).
+    Raises HTTPException if the repository has nothing indexed.
+    """
+    # Identical repeats are answered before any Chroma or embedding work
+    cached = query_cache.get_exact(
+        request.repo_id, request.selected_files, request.top_k, request.question
+    )
+    if cached is not None:
+        if SHARED_CHROMA:
+            # Raises if another worker has deleted the repo since
+            await run_in_threadpool(get_repo_collection, request.repo_id)
+        return cached, None, [], []
+
+    # Chroma and the encoder are blocking, so every call below runs on the
+    # thread pool and the loop keeps serving other requests meanwhile
+    collection = await run_in_threadpool(get_repo_collection, request.repo_id)
+
+    count = collection.metadata.get("chunk_count")
+    if count is None:
+        # Indexed before totals were stored on the collection
+        count = await run_in_threadpool(collection.count)
+    if count == 0:
+        raise HTTPException(
+            status_code=400,
+            detail="No documents in repository. Upload and index code first."
         )
 
-        documents, metadatas, ids = [], [], []
-        for i, chunk in enumerate(chunks):
-            documents.append(chunk.content)
-            metadatas.append({
-                "file_path": chunk.file_path,
-                "start_line": chunk.start_line,
-                "end_line": chunk.end_line,
-                "language": chunk.language,
-                "chunk_type": chunk.chunk_type
-            })
-            ids.append(f"{repo_id}_{i}")
+    # Embed once: the vector keys the semantic cache and drives retrieval
+    question_embedding = (await run_in_threadpool(
+        embedding_function, [QueryCache.normalize_question(request.question)]
+    ))[0]
+    cached = query_cache.get(
+        request.repo_id, request.selected_files, request.top_k, question_embedding
+    )
+    if cached is None:
+        cached = await run_in_threadpool(
+            persistent_query_cache.get,
+            request.repo_id, request.selected_files, request.top_k, question_embedding
+        )
+        if cached is not None:
+            query_cache.put(request.repo_id, request.selected_files, request.top_k,
+                            request.question, question_embedding, cached)
+    if cached is not None:
+        return cached, None, [], []
+
+    # Semantic retrieval — scoped to selected files if provided
+    k = request.top_k * 2 if request.selected_files else request.top_k
+    n_candidates = k * RERANK_CANDIDATE_FACTOR if reranker is not None else k
+    if request.selected_files:
+        results = await run_in_threadpool(
+            collection.query,
+            query_embeddings=[question_embedding],
+            n_results=min(n_candidates, count),
+            where={"file_path": {"$in": request.selected_files}}
+        )
+    else:
+        results = await run_in_threadpool(
+            collection.query,
+            query_embeddings=[question_embedding],
+            n_results=min(n_candidates, count)
+        )
 
-        collection.add(documents=documents, metadatas=metadatas, ids=ids)
+    documents = results['documents'][0] if results['documents'] else []
+    metadatas = results['metadatas'][0] if results['metadatas'] else []
+    if reranker is not None and len(documents) > k:
+        documents, metadatas = await run_in_threadpool(
+            rerank, request.question, documents, metadatas, k
+        )
+    documents, metadatas = fit_context_budget(documents, metadatas)
+    return None, question_embedding, documents, metadatas
 
-        lang_counts = {}
-        for chunk in chunks:
-            lang_counts[chunk.language] = lang_counts.get(chunk.language, 0) + 1
 
-        return {
-            "repo_id": repo_id,
-            "collection_name": collection_name,
-            "filename": display_name,
-            "status": "success",
-            "chunks_created": len(chunks),
-            "languages": lang_counts,
-            "message": f"Repository indexed successfully — {len(chunks)} code chunks."
+def rerank(question: str, documents: List[str], metadatas: List[dict], k: int) -> tuple:
+    """Keep the k candidates the cross-encoder scores most relevant, best first"""
+    scores = reranker.predict([(question, doc) for doc in documents])
+    order = sorted(range(len(documents)), key=lambda i: scores[i], reverse=True)[:k]
+    return [documents[i] for i in order], [metadatas[i] for i in order]
+
+
+def fit_context_budget(documents: List[str], metadatas: List[dict]) -> tuple:
+    """
+    Keep the leading (most relevant) chunks that fit CONTEXT_TOKEN_BUDGET.
+    The best match is always kept.
+    """
+    used = 0
+    for i, doc in enumerate(documents):
+        used += len(doc) // CHARS_PER_TOKEN + 1
+        if used > CONTEXT_TOKEN_BUDGET and i > 0:
+            print(f"Context budget reached; dropping {len(documents) - i} of {len(documents)} chunks")
+            return documents[:i], metadatas[:i]
+    return documents, metadatas
+
+
+def build_context(documents: List[str], metadatas: List[dict]) -> str:
+    return "\n---\n".join(
+        f"[Source {i+1}: {meta.get('file_path','unknown')}, "
+        f"line {meta.get('start_line','?')}]\n{doc}\n"
+        for i, (doc, meta) in enumerate(zip(documents, metadatas))
+    )
+
+
+# Static instructions go in the system prompt, built once at import; the
+# user turn carries only the retrieved snippets and the question
+SYSTEM_PROMPT = """You are a code analysis assistant. Answer the user's question based on the provided code snippets.
+
+Instructions:
+- Provide a clear, concise answer based on the snippets.
+- Reference specific files and line numbers when relevant.
+- If the snippets don't contain enough information, say so.
+- Use markdown formatting for code examples."""
+
+SUGGESTION_SYSTEM_PROMPT = """You are a code analysis assistant. The user is asking for code improvement suggestions.
+
+Instructions:
+- Analyze the code and provide specific, actionable improvement suggestions.
+- For each suggestion provide: description, file and line numbers, original code, improved code, explanation.
+
+Format:
+1. Brief summary answer
+2. For each suggestion:
+
+   **Suggestion [N]: [Title]**
+   File: [file_path] | Lines: [start]-[end]
+
+   Original Code:
+   ```
+   [original code]
+   ```
+   Improved Code:
+   ```
+   [improved code]
+   ```
+   Explanation: [why this is better]"""
+
+# Questions containing any of these are treated as improvement requests
+SUGGESTION_KEYWORDS = (
+    'improve', 'fix', 'refactor', 'optimize', 'suggest',
+    'change', 'modify', 'better', 'update'
+)
+
+
+def build_prompt(question: str, documents: List[str], metadatas: List[dict]) -> tuple:
+    """
+    Returns (system, content) blocks for the question.
+    The system prompt and the snippets are marked as prompt-cache breakpoints,
+    so a follow-up that retrieves the same chunks reuses the cached prefix
+    and only the question is billed at the full input rate.
+    """
+    # Snippets are listed by path and line rather than by relevance, so
+    # questions that retrieve the same chunks produce the same prefix;
+    # callers keep relevance order for sources and validation
+    order = sorted(
+        range(len(documents)),
+        key=lambda i: (metadatas[i].get('file_path', ''), metadatas[i].get('start_line', 0))
+    )
+    context = build_context([documents[i] for i in order], [metadatas[i] for i in order])
+
+    lowered = question.lower()
+    is_suggestion_request = any(kw in lowered for kw in SUGGESTION_KEYWORDS)
+    system = [{
+        "type": "text",
+        "text": SUGGESTION_SYSTEM_PROMPT if is_suggestion_request else SYSTEM_PROMPT,
+        "cache_control": {"type": "ephemeral"}
+    }]
+    content = [
+        {
+            "type": "text",
+            "text": f"Retrieved Code Snippets:\n{context}",
+            "cache_control": {"type": "ephemeral"}
+        },
+        {"type": "text", "text": f"User Question: {question}"}
+    ]
+    return system, content
+
+
+def usage_tokens(usage) -> int:
+    """Total tokens for a call; input_tokens leaves out prompt-cache reads and writes"""
+    return (
+        usage.input_tokens + usage.output_tokens
+        + (getattr(usage, "cache_creation_input_tokens", None) or 0)
+        + (getattr(usage, "cache_read_input_tokens", None) or 0)
+    )
+
+
+SNIPPET_CHARS = 200
+
+
+def build_sources(documents: List[str], metadatas: List[dict]) -> List[dict]:
+    # Only short documents are passed through whole; the rest are sliced once
+    snippets = [
+        doc if len(doc) <= SNIPPET_CHARS else doc[:SNIPPET_CHARS] + "..."
+        for doc in documents
+    ]
+    return [
+        {
+            "file_path": meta.get('file_path', 'unknown'),
+            "start_line": meta.get('start_line', 0),
+            "end_line": meta.get('end_line', 0),
+            "language": meta.get('language', 'unknown'),
+            "snippet": snippet
         }
+        for snippet, meta in zip(snippets, metadatas)
+    ]
+
+
+async def finalize_query(request: QueryRequest, question_embedding, answer: str,
+                         tokens_used: int, response_time: float, context: str,
+                         sources: List[dict]) -> tuple:
+    """
+    Validate the answer, record metrics and cache the response.
+    Returns (response_fields, query_id).
+    """
+    # TIPS Framework — validate every answer with Haiku as judge; the
+    # metrics write doesn't depend on it, so the two overlap
+    validation_preview, query_id = await asyncio.gather(
+        tips_validate(
+            question=request.question,
+            answer=answer,
+            context=context
+        ),
+        record_query_metrics(
+            request.repo_id, request.question, response_time, tokens_used,
+            request.selected_files
+        )
+    )
 
-    finally:
-        if extracted_dir and os.path.exists(extracted_dir):
-            shutil.rmtree(extracted_dir, ignore_errors=True)
+    response_fields = {
+        "answer": answer,
+        "sources": sources,
+        "tokens_used": tokens_used,
+        "validation_preview": validation_preview
+    }
+    query_cache.put(request.repo_id, request.selected_files, request.top_k,
+                    request.question, question_embedding, response_fields)
+    try:
+        await run_in_threadpool(
+            persistent_query_cache.put,
+            request.repo_id, request.selected_files, request.top_k,
+            request.question, question_embedding, response_fields
+        )
+    except Exception as e:
+        print(f"Persistent query cache write failed: {e}")
+
+    return response_fields, query_id
+
+
+NO_MATCH_ANSWER = "I couldn't find relevant code to answer your question."
+
+
+def sse_event(event: str, data) -> str:
+    """Format one server-sent event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 
 # ── Endpoints ─────────────────────────────────────────────────────────────────
@@ -279,7 +895,7 @@ async def root():
     return {
         "message": "Code Repository Q&A API",
         "status": "running",
-        "endpoints": ["/upload", "/upload-github", "/query", "/repos", "/health"]
+        "endpoints": ["/upload", "/upload-github", "/query", "/query/stream", "/repos", "/health"]
     }
 
 
@@ -287,7 +903,7 @@ async def root():
 async def health_check():
     return {
         "status": "healthy",
-        "chroma_collections": len(chroma_client.list_collections()),
+        "chroma_collections": len(await run_in_threadpool(chroma_client.list_collections)),
         "anthropic_configured": bool(os.getenv("ANTHROPIC_API_KEY"))
     }
 
@@ -295,25 +911,23 @@ async def health_check():
 @app.post("/upload")
 async def upload_repository(file: UploadFile = File(...)):
     """Upload a repository as a zip file."""
-    temp_zip = None
     try:
         if not file.filename.endswith('.zip'):
             raise HTTPException(status_code=400, detail="Only .zip files are supported")
 
-        temp_zip = tempfile.NamedTemporaryFile(delete=False, suffix='.zip')
-        temp_zip.write(await file.read())
-        temp_zip.close()
-
-        result = index_zip(temp_zip.name, file.filename)
+        # Read the archive straight from the upload's own spool file instead of
+        # copying it to another temp file first. fileno() rolls a small,
+        # in-memory spool over to disk; reopening that descriptor gives zipfile
+        # a plain seekable file (SpooledTemporaryFile lacks seekable() before 3.11)
+        fd = await run_in_threadpool(file.file.fileno)
+        with os.fdopen(os.dup(fd), 'rb') as zip_file:
+            result = await run_index_zip(zip_file, file.filename)
         return result
 
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing repository: {str(e)}")
-    finally:
-        if temp_zip and os.path.exists(temp_zip.name):
-            os.unlink(temp_zip.name)
 
 
 @app.post("/upload-github")
@@ -324,7 +938,6 @@ async def upload_github_repository(request: GitHubUploadRequest):
       - https://github.com/owner/repo
       - https://github.com/owner/repo/tree/branch
     """
-    temp_zip_path = None
     try:
         owner, repo, detected_branch = parse_github_url(request.url)
         branch = request.branch or detected_branch
@@ -334,44 +947,45 @@ async def upload_github_repository(request: GitHubUploadRequest):
         if branch == 'main':
             branches_to_try.append('master')
 
-        zip_content = None
         used_branch = None
+        digest = None
 
-        async with httpx.AsyncClient(
-            timeout=60.0,
-            follow_redirects=True,
-            headers={"User-Agent": "code-repository-qa/1.1"}
-        ) as client:
+        # Anonymous temp file: removed by the OS however the request ends
+        with tempfile.TemporaryFile(suffix='.zip') as zip_file:
             for b in branches_to_try:
                 download_url = (
                     f"https://github.com/{owner}/{repo}"
                     f"/archive/refs/heads/{b}.zip"
                 )
-                response = await client.get(download_url)
-                if response.status_code == 200:
-                    zip_content = response.content
+                # Stream the archive to disk in 1 MB blocks, hashing as it
+                # arrives; it is never held in memory as a whole
+                async with github_client.stream("GET", download_url) as response:
+                    if response.status_code != 200:
+                        continue
+                    digest = hashlib.sha256()
+                    async for block in response.aiter_bytes(1 << 20):
+                        digest.update(block)
+                        zip_file.write(block)
                     used_branch = b
                     break
 
-        if zip_content is None:
-            raise HTTPException(
-                status_code=404,
-                detail=(
-                    f"Could not download {owner}/{repo}. "
-                    "Check that the URL is correct and the repository is public."
+            if used_branch is None:
+                raise HTTPException(
+                    status_code=404,
+                    detail=(
+                        f"Could not download {owner}/{repo}. "
+                        "Check that the URL is correct and the repository is public."
+                    )
                 )
-            )
 
-        # Save to temp file and index
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.zip') as tmp:
-            tmp.write(zip_content)
-            temp_zip_path = tmp.name
+            zip_file.seek(0)
+            result = await run_index_zip(
+                zip_file,
+                display_name=f"{owner}/{repo}",
+                extra_metadata={"source": "github", "branch": used_branch, "github_url": request.url},
+                zip_sha256=digest.hexdigest()
+            )
 
-        result = index_zip(
-            temp_zip_path,
-            display_name=f"{owner}/{repo}",
-            extra_metadata={"source": "github", "branch": used_branch, "github_url": request.url}
-        )
         result["github_url"] = request.url
         result["branch"] = used_branch
         result["message"] = (
@@ -389,9 +1003,6 @@ async def upload_github_repository(request: GitHubUploadRequest):
             status_code=500,
             detail=f"Error processing GitHub repository: {str(e)}"
         )
-    finally:
-        if temp_zip_path and os.path.exists(temp_zip_path):
-            os.unlink(temp_zip_path)
 
 
 @app.post("/query", response_model=QueryResponse)
@@ -400,161 +1011,41 @@ async def query_repository(request: QueryRequest):
     start_time = time.time()
 
     try:
-        collection_name = f"repo_{request.repo_id}"
-        collection = chroma_client.get_collection(name=collection_name)
-
-        count = collection.count()
-        if count == 0:
-            raise HTTPException(
-                status_code=400,
-                detail="No documents in repository. Upload and index code first."
-            )
-
-        # Semantic retrieval — scoped to selected files if provided
-        if request.selected_files:
-            results = collection.query(
-                query_texts=[request.question],
-                n_results=min(request.top_k * 2, count),
-                where={"file_path": {"$in": request.selected_files}}
-            )
-        else:
-            results = collection.query(
-                query_texts=[request.question],
-                n_results=min(request.top_k, count)
-            )
-
-        documents = results['documents'][0] if results['documents'] else []
-        metadatas = results['metadatas'][0] if results['metadatas'] else []
+        cached, question_embedding, documents, metadatas = await retrieve_for_query(request)
+        if cached is not None:
+            return QueryResponse(**cached)
 
         if not documents:
             return QueryResponse(
-                answer="I couldn't find relevant code to answer your question.",
+                answer=NO_MATCH_ANSWER,
                 sources=[],
                 tokens_used=0
             )
 
-        # Build context
-        context_parts = []
-        for i, (doc, meta) in enumerate(zip(documents, metadatas)):
-            context_parts.append(
-                f"[Source {i+1}: {meta.get('file_path','unknown')}, "
-                f"line {meta.get('start_line','?')}]\n{doc}\n"
-            )
-        context = "\n---\n".join(context_parts)
-
-        # Detect improvement requests
-        suggestion_keywords = [
-            'improve', 'fix', 'refactor', 'optimize', 'suggest',
-            'change', 'modify', 'better', 'update'
-        ]
-        is_suggestion_request = any(
-            kw in request.question.lower() for kw in suggestion_keywords
-        )
-
-        if is_suggestion_request:
-            prompt = f"""You are a code analysis assistant. The user is asking for code improvement suggestions.
-
-Retrieved Code Snippets:
-{context}
-
-User Question: {request.question}
-
-Instructions:
-- Analyze the code and provide specific, actionable improvement suggestions.
-- For each suggestion provide: description, file and line numbers, original code, improved code, explanation.
-
-Format:
-1. Brief summary answer
-2. For each suggestion:
-
-   **Suggestion [N]: [Title]**
-   File: [file_path] | Lines: [start]-[end]
-
-   Original Code:
-   ```
-   [original code]
-   ```
-   Improved Code:
-   ```
-   [improved code]
-   ```
-   Explanation: [why this is better]"""
-        else:
-            prompt = f"""You are a code analysis assistant. Answer the user's question based on the provided code snippets.
-
-Retrieved Code Snippets:
-{context}
-
-User Question: {request.question}
+        context = build_context(documents, metadatas)
+        system, content = build_prompt(request.question, documents, metadatas)
 
-Instructions:
-- Provide a clear, concise answer based on the snippets above.
-- Reference specific files and line numbers when relevant.
-- If the snippets don't contain enough information, say so.
-- Use markdown formatting for code examples."""
-
-        message = anthropic_client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=2000,
-            messages=[{"role": "user", "content": prompt}]
-        )
+        async with claude_semaphore:
+            message = await anthropic_client.messages.create(
+                model="claude-sonnet-4-20250514",
+                max_tokens=2000,
+                system=system,
+                messages=[{"role": "user", "content": content}]
+            )
 
         answer = message.content[0].text
-        tokens_used = message.usage.input_tokens + message.usage.output_tokens
+        tokens_used = usage_tokens(message.usage)
         response_time = time.time() - start_time
 
-        sources = [
-            {
-                "file_path": meta.get('file_path', 'unknown'),
-                "start_line": meta.get('start_line', 0),
-                "end_line": meta.get('end_line', 0),
-                "language": meta.get('language', 'unknown'),
-                "snippet": doc[:200] + "..." if len(doc) > 200 else doc
-            }
-            for doc, meta in zip(documents, metadatas)
-        ]
-
-        # Save metrics (non-critical — never crashes the query)
-        try:
-            conn = sqlite3.connect('metrics.db', timeout=10, check_same_thread=False)
-            conn.execute('PRAGMA journal_mode=WAL')
-            c = conn.cursor()
-            c.execute(
-                'INSERT INTO query_metrics '
-                '(repo_id, question, response_time, tokens_used, files_queried) '
-                'VALUES (?, ?, ?, ?, ?)',
-                (
-                    request.repo_id, request.question, response_time, tokens_used,
-                    json.dumps(request.selected_files) if request.selected_files else None
-                )
-            )
-            if request.selected_files:
-                for fp in request.selected_files:
-                    c.execute(
-                        'INSERT OR IGNORE INTO file_access '
-                        '(repo_id, file_path, access_count, last_accessed) '
-                        'VALUES (?, ?, 1, CURRENT_TIMESTAMP)',
-                        (request.repo_id, fp)
-                    )
-            conn.commit()
-            conn.close()
-        except Exception:
-            pass
-
-        # TIPS Framework — validate every answer with Haiku as judge
-        validation_preview = await tips_validate(
-            question=request.question,
-            answer=answer,
-            context=context
+        sources = build_sources(documents, metadatas)
+        response_fields, query_id = await finalize_query(
+            request, question_embedding, answer, tokens_used, response_time, context, sources
         )
 
         return QueryResponse(
-            answer=answer,
-            sources=sources,
-            tokens_used=tokens_used,
+            **response_fields,
             suggestions=[],
-            query_id=None,
-            validation_preview=validation_preview
+            query_id=query_id
         )
 
     except HTTPException:
@@ -565,33 +1056,122 @@ Instructions:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/query/stream")
+async def query_repository_stream(request: QueryRequest):
+    """
+    Same as /query, but streams the answer as server-sent events while
+    Claude writes it: `token` frames, then `sources`, then `done` with
+    tokens_used, query_id and validation_preview (or a single `error`).
+    """
+    start_time = time.time()
+
+    try:
+        cached, question_embedding, documents, metadatas = await retrieve_for_query(request)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Query error: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def events():
+        if cached is not None or not documents:
+            response = cached or {"answer": NO_MATCH_ANSWER, "sources": [], "tokens_used": 0}
+            yield sse_event("token", {"text": response["answer"]})
+            yield sse_event("sources", response["sources"])
+            yield sse_event("done", {
+                "tokens_used": response["tokens_used"],
+                "query_id": None,
+                "validation_preview": response.get("validation_preview")
+            })
+            return
+
+        try:
+            context = build_context(documents, metadatas)
+            system, content = build_prompt(request.question, documents, metadatas)
+
+            async with claude_semaphore:
+                async with anthropic_client.messages.stream(
+                    model="claude-sonnet-4-20250514",
+                    max_tokens=2000,
+                    system=system,
+                    messages=[{"role": "user", "content": content}]
+                ) as stream:
+                    async for text in stream.text_stream:
+                        yield sse_event("token", {"text": text})
+                    message = await stream.get_final_message()
+
+            answer = message.content[0].text
+            tokens_used = usage_tokens(message.usage)
+            response_time = time.time() - start_time
+
+            sources = build_sources(documents, metadatas)
+            yield sse_event("sources", sources)
+
+            response_fields, query_id = await finalize_query(
+                request, question_embedding, answer, tokens_used, response_time, context, sources
+            )
+            yield sse_event("done", {
+                "tokens_used": tokens_used,
+                "query_id": query_id,
+                "validation_preview": response_fields["validation_preview"]
+            })
+        except Exception as e:
+            print(f"Query stream error: {e}")
+            traceback.print_exc()
+            yield sse_event("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @app.get("/repos")
 async def list_repositories():
     """List all indexed repositories."""
     try:
-        collections = chroma_client.list_collections()
+        collections = [
+            col for col in await run_in_threadpool(chroma_client.list_collections)
+            if col.name.startswith("repo_")
+        ]
+        # Collections indexed before chunk_count was recorded have to be
+        # counted; do those round-trips concurrently rather than one by one
+        legacy = [col for col in collections if "chunk_count" not in col.metadata]
+        counts = await asyncio.gather(*(run_in_threadpool(col.count) for col in legacy))
+        legacy_counts = dict(zip((col.name for col in legacy), counts))
+
         repos = [
-            {
-                "repo_id": col.name.replace("repo_", ""),
-                "name": col.metadata.get("repo_name", "Unknown"),
-                "source": col.metadata.get("source", "upload"),
-                "branch": col.metadata.get("branch", None),
-                "github_url": col.metadata.get("github_url", None),
-                "document_count": col.count()
-            }
+            repository_summary(col, legacy_counts.get(col.name, col.metadata.get("chunk_count")))
             for col in collections
-            if col.name.startswith("repo_")
         ]
         return {"repositories": repos}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def repository_summary(col: chromadb.Collection, document_count: int) -> dict:
+    return {
+        "repo_id": col.name.replace("repo_", ""),
+        "name": col.metadata.get("repo_name", "Unknown"),
+        "source": col.metadata.get("source", "upload"),
+        "branch": col.metadata.get("branch", None),
+        "github_url": col.metadata.get("github_url", None),
+        "document_count": document_count,
+        "languages": json.loads(col.metadata.get("lang_counts", "{}"))
+    }
+
+
 @app.delete("/repos/{repo_id}")
 async def delete_repository(repo_id: str):
     """Delete a repository and its ChromaDB collection."""
     try:
-        chroma_client.delete_collection(name=f"repo_{repo_id}")
+        await run_in_threadpool(chroma_client.delete_collection, name=f"repo_{repo_id}")
+        # Other workers sharing the store drop theirs on their next hit,
+        # when get_repo_collection finds the collection gone
+        evict_repo(repo_id)
+        await run_in_threadpool(persistent_query_cache.invalidate_repo, repo_id)
         return {"message": f"Repository {repo_id} deleted successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -600,27 +1180,38 @@ async def delete_repository(repo_id: str):
 @app.get("/repos/{repo_id}/files")
 async def list_repository_files(repo_id: str):
     """List all files in a repository with chunk and line stats."""
-    try:
-        collection = chroma_client.get_collection(name=f"repo_{repo_id}")
-        results = collection.get(include=['metadatas'])
+    cached = lru_get(repo_files_cache, repo_id)
+    if cached is not None and not SHARED_CHROMA:
+        return cached
 
-        files_dict = {}
+    try:
+        collection = await run_in_threadpool(get_repo_collection, repo_id)
+        if cached is not None:
+            # Only served once the shared store confirms the repo still exists
+            return cached
+        results = await run_in_threadpool(collection.get, include=['metadatas'])
+
+        # file_path -> [language, chunk_count, total_lines]
+        stats = {}
         for meta in results['metadatas']:
             fp = meta.get('file_path', 'unknown')
-            if fp not in files_dict:
-                files_dict[fp] = {
-                    'file_path': fp,
-                    'language': meta.get('language', 'unknown'),
-                    'chunk_count': 0,
-                    'total_lines': 0
-                }
-            files_dict[fp]['chunk_count'] += 1
             end_line = meta.get('end_line', 0)
-            if end_line > files_dict[fp]['total_lines']:
-                files_dict[fp]['total_lines'] = end_line
-
-        files = sorted(files_dict.values(), key=lambda x: x['file_path'])
-        return {"repo_id": repo_id, "files": files, "total_files": len(files)}
+            entry = stats.get(fp)
+            if entry is None:
+                stats[fp] = [meta.get('language', 'unknown'), 1, max(end_line, 0)]
+            else:
+                entry[1] += 1
+                if end_line > entry[2]:
+                    entry[2] = end_line
+
+        files = [
+            {'file_path': fp, 'language': language,
+             'chunk_count': chunk_count, 'total_lines': total_lines}
+            for fp, (language, chunk_count, total_lines) in sorted(stats.items())
+        ]
+        result = {"repo_id": repo_id, "files": files, "total_files": len(files)}
+        lru_put(repo_files_cache, repo_id, result)
+        return result
 
     except Exception as e:
         print(f"List files error: {e}")
@@ -634,13 +1225,12 @@ async def rate_query(query_id: int, rating: int):
     if rating not in [1, -1]:
         raise HTTPException(status_code=400, detail="Rating must be 1 or -1")
     try:
-        conn = sqlite3.connect('metrics.db')
-        conn.cursor().execute(
-            'INSERT INTO query_ratings (query_id, rating) VALUES (?, ?)',
-            (query_id, rating)
-        )
-        conn.commit()
-        conn.close()
+        async with metrics_pool.connection() as conn:
+            await conn.execute(
+                'INSERT INTO query_ratings (query_id, rating) VALUES (?, ?)',
+                (query_id, rating)
+            )
+            await conn.commit()
         return {"message": "Rating saved", "query_id": query_id, "rating": rating}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -650,45 +1240,43 @@ async def rate_query(query_id: int, rating: int):
 async def get_metrics():
     """Get evaluation metrics and usage statistics."""
     try:
-        conn = sqlite3.connect('metrics.db')
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-
-        c.execute('''
-            SELECT COUNT(*) as total_queries,
-                   AVG(response_time) as avg_response_time,
-                   AVG(tokens_used) as avg_tokens,
-                   SUM(tokens_used) as total_tokens
-            FROM query_metrics
-        ''')
-        overall = dict(c.fetchone())
-
-        c.execute('''
-            SELECT id, repo_id, question, response_time, tokens_used, timestamp
-            FROM query_metrics ORDER BY timestamp DESC LIMIT 10
-        ''')
-        recent_queries = [dict(r) for r in c.fetchall()]
-
-        c.execute('''
-            SELECT file_path, access_count, last_accessed
-            FROM file_access ORDER BY access_count DESC LIMIT 10
-        ''')
-        popular_files = [dict(r) for r in c.fetchall()]
-
-        c.execute('''
-            SELECT COUNT(*) as total_ratings,
-                   SUM(CASE WHEN rating = 1 THEN 1 ELSE 0 END) as positive,
-                   SUM(CASE WHEN rating = -1 THEN 1 ELSE 0 END) as negative
-            FROM query_ratings
-        ''')
-        ratings = dict(c.fetchone())
-        conn.close()
+        async with metrics_pool.connection() as conn:
+            async with conn.execute('''
+                SELECT COUNT(*) as total_queries,
+                       AVG(response_time) as avg_response_time,
+                       AVG(tokens_used) as avg_tokens,
+                       SUM(tokens_used) as total_tokens
+                FROM query_metrics
+            ''') as c:
+                overall = dict(await c.fetchone())
+
+            async with conn.execute('''
+                SELECT id, repo_id, question, response_time, tokens_used, timestamp
+                FROM query_metrics ORDER BY timestamp DESC LIMIT 10
+            ''') as c:
+                recent_queries = [dict(r) for r in await c.fetchall()]
+
+            async with conn.execute('''
+                SELECT file_path, access_count, last_accessed
+                FROM file_access ORDER BY access_count DESC LIMIT 10
+            ''') as c:
+                popular_files = [dict(r) for r in await c.fetchall()]
+
+            async with conn.execute('''
+                SELECT COUNT(*) as total_ratings,
+                       SUM(CASE WHEN rating = 1 THEN 1 ELSE 0 END) as positive,
+                       SUM(CASE WHEN rating = -1 THEN 1 ELSE 0 END) as negative
+                FROM query_ratings
+            ''') as c:
+                ratings = dict(await c.fetchone())
 
         return {
             "overall": overall,
             "recent_queries": recent_queries,
             "popular_files": popular_files,
-            "ratings": ratings
+            "ratings": ratings,
+            "query_cache": query_cache.stats(),
+            "persistent_query_cache": persistent_query_cache.stats()
         }
     except Exception as e:
         traceback.print_exc()
@@ -697,4 +1285,4 @@ async def get_metrics():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop")
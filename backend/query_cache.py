@@ -0,0 +1,298 @@
+# Code Repository Q&A System
+# Copyright (c) 2025 James [Your Last Name]
+# Licensed under the MIT License
+# See LICENSE file in the project root for full license text
+
+"""
+Semantic query cache for the /query endpoint.
+Serves a stored answer when a new question embeds close enough to one
+already answered for the same repository and file selection.
+"""
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+
+def is_missing_collection(error: Exception) -> bool:
+    """Whether a Chroma call failed because the collection does not exist.
+    
+    The embedded client raises ValueError; the HTTP client re-raises the
+    server's error as a plain Exception carrying the same message.
+    """
+    return "does not exist" in str(error)
+
+
+class _Entry:
+    """One cached answer; its question's embedding lives in QueryCache._matrix"""
+
+    __slots__ = ('scope', 'exact_key', 'value', 'expires_at')
+
+    def __init__(self, scope: tuple, exact_key: tuple, value: dict, expires_at: float):
+        self.scope = scope
+        self.exact_key = exact_key
+        self.value = value
+        self.expires_at = expires_at
+
+
+class QueryCache:
+    """LRU + TTL cache of query responses, matched exactly or by cosine similarity"""
+
+    INITIAL_ROWS = 64
+
+    def __init__(self, max_size: int = 1000, ttl_seconds: float = 3600,
+                 threshold: float = 0.95):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        # Matrix row -> entry, least recently used first
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        # (repo_id, selected files) -> rows of its entries, so lookups only
+        # compare against questions asked over the same sources
+        self._scopes: Dict[tuple, Dict[int, None]] = {}
+        # (scope, lowercased question) -> row, for repeats that need no embedding
+        self._exact: Dict[tuple, int] = {}
+        # Unit embeddings, one contiguous float32 row per entry; allocated on
+        # first put, once the embedding width is known, and grown by doubling
+        # up to max_size rows
+        self._matrix: Optional[np.ndarray] = None
+        self._free_rows = []
+        self._next_row = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.exact_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def normalize_question(question: str) -> str:
+        """Collapse whitespace so trivially different phrasings embed the same"""
+        return ' '.join(question.split())
+
+    @classmethod
+    def _exact_key(cls, scope: tuple, question: str) -> tuple:
+        return (scope, cls.normalize_question(question).lower())
+
+    @staticmethod
+    def _scope(repo_id: str, selected_files: Optional[Sequence[str]], top_k: int) -> tuple:
+        # top_k changes how many sources back the answer, so it is part of the key
+        return (repo_id, tuple(sorted(selected_files)) if selected_files else None, top_k)
+
+    @staticmethod
+    def _unit(embedding: Sequence[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get_exact(self, repo_id: str, selected_files: Optional[Sequence[str]],
+                  top_k: int, question: str) -> Optional[dict]:
+        """Return the cached response for this exact question, without embedding it.
+        
+        A miss here is not counted; the caller goes on to the semantic lookup.
+        """
+        key = self._exact_key(self._scope(repo_id, selected_files, top_k), question)
+        with self._lock:
+            row = self._exact.get(key)
+            if row is None:
+                return None
+            if self._entries[row].expires_at <= time.monotonic():
+                self._remove(row)
+                self.evictions += 1
+                return None
+            self._entries.move_to_end(row)
+            self.hits += 1
+            self.exact_hits += 1
+            return self._entries[row].value
+
+    def get(self, repo_id: str, selected_files: Optional[Sequence[str]],
+            top_k: int, embedding: Sequence[float]) -> Optional[dict]:
+        """Return the cached response for the most similar question, if any"""
+        scope = self._scope(repo_id, selected_files, top_k)
+        vector = self._unit(embedding)
+        now = time.monotonic()
+
+        with self._lock:
+            ids = self._scopes.get(scope)
+            if ids:
+                for entry_id in [i for i in ids if self._entries[i].expires_at <= now]:
+                    self._remove(entry_id)
+                    self.evictions += 1
+            if not ids:
+                self.misses += 1
+                return None
+
+            rows = np.fromiter(ids, dtype=np.intp, count=len(ids))
+            scores = self._matrix[rows] @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            entry_id = int(rows[best])
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            return self._entries[entry_id].value
+
+    def put(self, repo_id: str, selected_files: Optional[Sequence[str]], top_k: int,
+            question: str, embedding: Sequence[float], value: dict):
+        """Store a response under the question's text and embedding"""
+        scope = self._scope(repo_id, selected_files, top_k)
+        vector = self._unit(embedding)
+        exact_key = self._exact_key(scope, question)
+        entry = _Entry(scope, exact_key, value, time.monotonic() + self.ttl_seconds)
+
+        with self._lock:
+            if self._matrix is None:
+                rows = min(self.INITIAL_ROWS, self.max_size)
+                self._matrix = np.empty((rows, vector.shape[0]), dtype=np.float32)
+            if len(self._entries) >= self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+            if self._free_rows:
+                row = self._free_rows.pop()
+            else:
+                row = self._next_row
+                self._next_row += 1
+                if row == self._matrix.shape[0]:
+                    self._grow()
+            self._matrix[row] = vector
+            self._entries[row] = entry
+            self._scopes.setdefault(scope, {})[row] = None
+            self._exact[exact_key] = row
+
+    def _grow(self):
+        capacity = min(self._matrix.shape[0] * 2, self.max_size)
+        matrix = np.empty((capacity, self._matrix.shape[1]), dtype=np.float32)
+        matrix[:self._matrix.shape[0]] = self._matrix
+        self._matrix = matrix
+
+    def invalidate_repo(self, repo_id: str):
+        """Drop every entry for a repository, whatever files were selected"""
+        with self._lock:
+            for scope in [s for s in self._scopes if s[0] == repo_id]:
+                for entry_id in list(self._scopes[scope]):
+                    self._remove(entry_id)
+
+    def _remove(self, row: int):
+        entry = self._entries.pop(row)
+        rows = self._scopes[entry.scope]
+        del rows[row]
+        if not rows:
+            del self._scopes[entry.scope]
+        # A newer entry may have taken over this question's exact key
+        if self._exact.get(entry.exact_key) == row:
+            del self._exact[entry.exact_key]
+        self._free_rows.append(row)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "exact_hits": self.exact_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+
+class PersistentQueryCache:
+    """Second cache tier: answers stored in a per-repo Chroma collection.
+    
+    Survives restarts and is shared by every worker using the same Chroma
+    store, behind the in-process QueryCache.
+    """
+
+    COLLECTION_PREFIX = "qa_cache_"
+
+    def __init__(self, chroma_client, ttl_seconds: float = 24 * 3600,
+                 threshold: float = 0.95):
+        self.chroma_client = chroma_client
+        self.ttl_seconds = ttl_seconds
+        # Chroma reports cosine distance, i.e. 1 - similarity
+        self.max_distance = 1.0 - threshold
+        self.hits = 0
+        self.misses = 0
+
+    def _collection_name(self, repo_id: str) -> str:
+        return f"{self.COLLECTION_PREFIX}{repo_id}"
+
+    @staticmethod
+    def _scope_key(selected_files: Optional[Sequence[str]], top_k: int) -> str:
+        return json.dumps([top_k, sorted(selected_files) if selected_files else None])
+
+    def get(self, repo_id: str, selected_files: Optional[Sequence[str]],
+            top_k: int, embedding: Sequence[float]) -> Optional[dict]:
+        """Return the stored response for the nearest fresh question, if close enough"""
+        try:
+            collection = self.chroma_client.get_collection(name=self._collection_name(repo_id))
+        except Exception as e:
+            if not is_missing_collection(e):
+                raise
+            # No answers stored for this repo yet
+            self.misses += 1
+            return None
+
+        # Expired rows are filtered out, so they never hide a fresh match
+        results = collection.query(
+            query_embeddings=[list(embedding)],
+            n_results=1,
+            where={"$and": [
+                {"scope": self._scope_key(selected_files, top_k)},
+                {"created_at": {"$gte": time.time() - self.ttl_seconds}}
+            ]},
+            include=["metadatas", "distances"]
+        )
+
+        if not results["ids"] or not results["ids"][0]:
+            self.misses += 1
+            return None
+
+        if results["distances"][0][0] > self.max_distance:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return json.loads(results["metadatas"][0][0]["response"])
+
+    def put(self, repo_id: str, selected_files: Optional[Sequence[str]], top_k: int,
+            question: str, embedding: Sequence[float], value: dict):
+        """Store a response, keyed by its question's embedding, and drop expired ones"""
+        collection = self.chroma_client.get_or_create_collection(
+            name=self._collection_name(repo_id),
+            metadata={"hnsw:space": "cosine"}
+        )
+        now = time.time()
+        collection.delete(where={"created_at": {"$lt": now - self.ttl_seconds}})
+        collection.add(
+            ids=[uuid.uuid4().hex],
+            embeddings=[list(embedding)],
+            documents=[question],
+            metadatas=[{
+                "scope": self._scope_key(selected_files, top_k),
+                "created_at": now,
+                "response": json.dumps(value)
+            }]
+        )
+
+    def invalidate_repo(self, repo_id: str):
+        """Drop the repository's stored answers"""
+        try:
+            self.chroma_client.delete_collection(name=self._collection_name(repo_id))
+        except Exception as e:
+            if not is_missing_collection(e):
+                raise
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+        }
@@ -0,0 +1,93 @@
+import re
+
+import pytest
+
+from code_parser import CodeParser
+
+
+@pytest.fixture
+def ast_parser():
+    pytest.importorskip("tree_sitter_languages")
+    return CodeParser(max_chunk_size=1000, overlap=100)
+
+
+def _uncovered(text: str, chunks) -> str:
+    """Non-whitespace characters of text that no chunk contains"""
+    line_starts = [0] + [m.end() for m in re.finditer('\n', text)]
+    covered = bytearray(len(text))
+    prev, prev_end = -1, 0
+    for chunk in chunks:
+        # Prefer the latest match touching or overlapping the previous chunk:
+        # repetitive text (e.g. `1+1+...`) also matches at earlier offsets
+        pos = text.rfind(chunk.content, prev + 1, prev_end + len(chunk.content))
+        if pos < 0:
+            pos = text.find(chunk.content, max(line_starts[chunk.start_line - 1], prev + 1))
+        assert pos >= 0, chunk.content[:60]
+        covered[pos:pos + len(chunk.content)] = b'\x01' * len(chunk.content)
+        prev, prev_end = pos, pos + len(chunk.content)
+    return ''.join(ch for ch, c in zip(text, covered) if not c and not ch.isspace())
+
+
+PYTHON_SOURCE = (
+    'import os\n\n'
+    'HELP = """\n' + ''.join(f'marker{i} help text for option {i}\n' for i in range(150)) + '"""\n\n\n'
+    'class Handler(Base):\n'
+    '    @staticmethod\n'
+    '    def handle(request):\n' + ''.join(f'        value_{i} = request.get("{i}")\n' for i in range(120)) +
+    '        return value_0\n\n'
+    '    def close(self):\n'
+    '        pass\n'
+)
+
+JAVASCRIPT_SOURCE = (
+    'const tpl = `\n' + ''.join(f'marker{i} ${{name}} row {i}\n' for i in range(150)) + '`;\n\n'
+    'class Widget extends Base {\n' + ''.join(f'  method{i}(a, b) {{\n    return a + b * {i};\n  }}\n' for i in range(80)) +
+    '}\n'
+)
+
+
+@pytest.mark.parametrize("source,language", [
+    (PYTHON_SOURCE, 'python'),
+    (JAVASCRIPT_SOURCE, 'javascript'),
+], ids=['python', 'javascript'])
+def test_ast_chunks_cover_every_non_whitespace_byte(source, language, ast_parser):
+    chunks = ast_parser._chunk_ast(source.encode(), f"sample.{language}", language)
+
+    assert len(chunks) > 1
+    assert _uncovered(source, chunks) == ''
+
+
+@pytest.mark.parametrize("source,language", [
+    (PYTHON_SOURCE, 'python'),
+    (JAVASCRIPT_SOURCE, 'javascript'),
+], ids=['python', 'javascript'])
+def test_ast_chunks_have_no_token_sized_fragments(source, language, ast_parser):
+    chunks = ast_parser._chunk_ast(source.encode(), f"sample.{language}", language)
+
+    assert all(len(c.content.strip()) >= CodeParser.AST_MIN_CHUNK for c in chunks)
+
+
+@pytest.mark.parametrize("source,language", [
+    ('x = ' + '+'.join(['1'] * 20000) + '\n', 'python'),
+    ('var x = ' + '+'.join(['a'] * 20000) + ';\n', 'javascript'),
+    ('y = ' + 'f(' * 3000 + '1' + ')' * 3000 + '\n', 'python'),
+], ids=['python-binary', 'javascript-binary', 'python-calls'])
+def test_deeply_nested_expressions_are_chunked_within_budget(source, language, ast_parser):
+    chunks = ast_parser._chunk_ast(source.encode(), f"generated.{language}", language)
+
+    assert len(chunks) > 1
+    assert _uncovered(source, chunks) == ''
+    assert all(len(c.content) <= 1000 + CodeParser.AST_MIN_CHUNK for c in chunks)
+
+
+def test_byte_windows_never_split_a_utf8_sequence():
+    parser = CodeParser(max_chunk_size=1000, overlap=100)
+    # One long line, so every cut is a byte cut; the odd prefix puts window
+    # edges inside 2-, 3- and 4-byte characters
+    text = 'x' + 'é€😀' * 400 + '\n' + 'ascii tail\n' * 5
+    chunks = parser.chunk_by_lines(text.encode(), 'notes.txt', 'text')
+
+    assert len(chunks) > 3
+    assert all('\ufffd' not in c.content for c in chunks)
+    assert all(len(c.content.encode()) <= 1000 for c in chunks)
+    assert _uncovered(text, chunks) == ''
@@ -0,0 +1,183 @@
+import pytest
+
+import query_cache
+from query_cache import PersistentQueryCache, QueryCache
+
+
+class FakeTime:
+    """Stands in for the time module, so TTLs expire on demand"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(query_cache, 'time', fake)
+    return fake
+
+
+def _answer(n: int) -> dict:
+    return {'answer': f'answer {n}'}
+
+
+def test_semantic_hit_needs_threshold_similarity(clock):
+    cache = QueryCache(max_size=10, threshold=0.95)
+    cache.put('repo', None, 5, 'how is parsing done', [1.0, 0.0], _answer(1))
+
+    assert cache.get('repo', None, 5, [0.99, 0.05]) == _answer(1)
+    assert cache.get('repo', None, 5, [0.0, 1.0]) is None
+    assert cache.get('other', None, 5, [1.0, 0.0]) is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 2
+
+
+def test_put_evicts_least_recently_used(clock):
+    cache = QueryCache(max_size=2)
+    cache.put('repo', None, 5, 'first', [1.0, 0.0, 0.0], _answer(1))
+    cache.put('repo', None, 5, 'second', [0.0, 1.0, 0.0], _answer(2))
+    # Touching the first entry makes the second the eviction candidate
+    assert cache.get('repo', None, 5, [1.0, 0.0, 0.0]) == _answer(1)
+    cache.put('repo', None, 5, 'third', [0.0, 0.0, 1.0], _answer(3))
+
+    assert cache.get('repo', None, 5, [0.0, 1.0, 0.0]) is None
+    assert cache.get('repo', None, 5, [1.0, 0.0, 0.0]) == _answer(1)
+    assert cache.get('repo', None, 5, [0.0, 0.0, 1.0]) == _answer(3)
+    assert cache.stats()['size'] == 2
+    assert cache.stats()['evictions'] == 1
+
+
+def test_get_drops_expired_entries(clock):
+    cache = QueryCache(max_size=10, ttl_seconds=60)
+    cache.put('repo', None, 5, 'old', [1.0, 0.0], _answer(1))
+    clock.now += 30
+    cache.put('repo', None, 5, 'new', [0.0, 1.0], _answer(2))
+    clock.now += 30
+
+    assert cache.get('repo', None, 5, [1.0, 0.0]) is None
+    assert cache.get('repo', None, 5, [0.0, 1.0]) == _answer(2)
+    assert cache.stats()['size'] == 1
+    assert cache.stats()['evictions'] == 1
+
+
+def test_invalidate_repo_drops_every_selection(clock):
+    cache = QueryCache(max_size=10)
+    cache.put('repo', None, 5, 'all files', [1.0, 0.0], _answer(1))
+    cache.put('repo', ['a.py', 'b.py'], 5, 'two files', [1.0, 0.0], _answer(2))
+    cache.put('other', None, 5, 'all files', [1.0, 0.0], _answer(3))
+
+    cache.invalidate_repo('repo')
+
+    assert cache.get('repo', None, 5, [1.0, 0.0]) is None
+    assert cache.get('repo', ['b.py', 'a.py'], 5, [1.0, 0.0]) is None
+    assert cache.get('other', None, 5, [1.0, 0.0]) == _answer(3)
+    assert cache.stats()['size'] == 1
+
+
+def test_freed_rows_are_recycled(clock):
+    cache = QueryCache(max_size=2)
+    cache.put('repo', None, 5, 'first', [1.0, 0.0, 0.0], _answer(1))
+    cache.put('repo', None, 5, 'second', [0.0, 1.0, 0.0], _answer(2))
+    cache.invalidate_repo('repo')
+    cache.put('repo', None, 5, 'third', [0.0, 0.0, 1.0], _answer(3))
+    cache.put('repo', None, 5, 'fourth', [1.0, 1.0, 0.0], _answer(4))
+
+    assert cache._matrix.shape == (2, 3)
+    assert sorted(cache._entries) == [0, 1]
+    # A recycled row holds the new embedding, not the evicted one
+    assert cache.get('repo', None, 5, [1.0, 0.0, 0.0]) is None
+    assert cache.get('repo', None, 5, [0.0, 0.0, 1.0]) == _answer(3)
+    assert cache.get('repo', None, 5, [1.0, 1.0, 0.0]) == _answer(4)
+
+
+def test_get_exact_matches_normalized_question_within_scope(clock):
+    cache = QueryCache(max_size=10, ttl_seconds=60)
+    cache.put('repo', ['a.py'], 5, 'How is  parsing done?', [1.0, 0.0], _answer(1))
+
+    assert cache.get_exact('repo', ['a.py'], 5, 'how is parsing\ndone?') == _answer(1)
+    # top_k decides how many sources back the answer, so it is part of the scope
+    assert cache.get_exact('repo', ['a.py'], 3, 'How is parsing done?') is None
+    assert cache.get('repo', ['a.py'], 3, [1.0, 0.0]) is None
+    assert cache.get_exact('repo', None, 5, 'How is parsing done?') is None
+    clock.now += 60
+    assert cache.get_exact('repo', ['a.py'], 5, 'How is parsing done?') is None
+    assert cache.stats()['size'] == 0
+
+
+def test_removing_a_replaced_entry_keeps_the_newer_exact_key(clock):
+    cache = QueryCache(max_size=2)
+    cache.put('repo', None, 5, 'what is main', [1.0, 0.0], _answer(1))
+    cache.put('repo', None, 5, 'What is main', [0.0, 1.0], _answer(2))
+    # Evicts the first entry, which shares its exact key with the second
+    cache.put('repo', None, 5, 'unrelated', [1.0, 1.0], _answer(3))
+
+    assert cache.get_exact('repo', None, 5, 'what is main') == _answer(2)
+
+
+def test_matrix_doubles_up_to_max_size(clock, monkeypatch):
+    monkeypatch.setattr(QueryCache, 'INITIAL_ROWS', 2)
+    cache = QueryCache(max_size=5)
+    shapes = []
+    for n in range(7):
+        vector = [0.0] * 7
+        vector[n] = 1.0
+        cache.put('repo', None, 5, f'question {n}', vector, _answer(n))
+        shapes.append(cache._matrix.shape[0])
+
+    assert shapes == [2, 2, 4, 4, 5, 5, 5]
+    # Rows copied over on growth still match their questions
+    assert cache.get('repo', None, 5, [0, 0, 1, 0, 0, 0, 0]) == _answer(2)
+    assert cache.get('repo', None, 5, [0, 0, 0, 0, 0, 0, 1]) == _answer(6)
+    assert cache.get('repo', None, 5, [1, 0, 0, 0, 0, 0, 0]) is None
+
+
+@pytest.fixture
+def chroma_client(tmp_path):
+    chromadb = pytest.importorskip("chromadb")
+    from chromadb.config import Settings
+    return chromadb.PersistentClient(path=str(tmp_path),
+                                     settings=Settings(anonymized_telemetry=False))
+
+
+def test_persistent_cache_serves_only_fresh_rows(clock, chroma_client):
+    cache = PersistentQueryCache(chroma_client, ttl_seconds=60, threshold=0.95)
+    cache.put('repo', None, 5, 'how is parsing done', [1.0, 0.0], _answer(1))
+    clock.now += 50
+    cache.put('repo', None, 5, 'how is parsing done now', [0.99, 0.1], _answer(2))
+    clock.now += 20
+
+    # The expired row is nearer, but must not hide the fresh one
+    assert cache.get('repo', None, 5, [1.0, 0.0]) == _answer(2)
+    clock.now += 60
+    assert cache.get('repo', None, 5, [1.0, 0.0]) is None
+
+
+def test_persistent_cache_is_scoped_by_files_and_top_k(clock, chroma_client):
+    cache = PersistentQueryCache(chroma_client, threshold=0.95)
+    cache.put('repo', ['b.py', 'a.py'], 5, 'what does main do', [1.0, 0.0], _answer(1))
+
+    assert cache.get('repo', ['a.py', 'b.py'], 5, [1.0, 0.0]) == _answer(1)
+    assert cache.get('repo', ['a.py'], 5, [1.0, 0.0]) is None
+    assert cache.get('repo', None, 5, [1.0, 0.0]) is None
+    assert cache.get('repo', ['a.py', 'b.py'], 3, [1.0, 0.0]) is None
+    assert cache.get('other', ['a.py', 'b.py'], 5, [1.0, 0.0]) is None
+
+
+class _FailingChroma:
+    def get_collection(self, name):
+        raise ConnectionError("Could not connect to tenant default_tenant")
+
+
+def test_persistent_cache_surfaces_chroma_failures():
+    cache = PersistentQueryCache(_FailingChroma())
+
+    with pytest.raises(ConnectionError):
+        cache.get('repo', None, 5, [1.0, 0.0])
+    assert cache.stats()['misses'] == 0